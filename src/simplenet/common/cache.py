@@ -0,0 +1,276 @@
+# Copyright 2012 Locaweb.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+# @author: Juliano Martinez (ncode), Locaweb.
+# @author: Luiz Ozaki, Locaweb.
+
+"""Cache storage for http_utils.cache: the in-process tier and the
+shared backends behind it, Redis or, for tests and single node deploys,
+process memory. Backends raise CacheUnavailable on any failure, so callers
+only have to fall back to an uncached call."""
+
+import threading
+import time
+
+import redis
+
+from simplenet.common.config import get_logger, get_option
+
+logger = get_logger()
+
+_backend = None
+_backend_lock = threading.Lock()
+
+# Positions on the entries of the recency list
+PREV, NEXT, KEY, VALUE, EXPIRES = range(5)
+
+
+class LRUCache(object):
+    """Bounded mapping dropping the least recently used entry when full and
+    the entries older than their ttl when read. Entries are kept on a
+    circular doubly linked list, most recent first, so every operation is
+    O(1). It runs on python 2.6, which has no OrderedDict."""
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.root = []
+        self.root[:] = [self.root, self.root, None, None, None]
+        self.counters = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+            'expirations': 0,
+        }
+
+    def _unlink_(self, entry):
+        entry[PREV][NEXT] = entry[NEXT]
+        entry[NEXT][PREV] = entry[PREV]
+
+    def _push_(self, entry):
+        first = self.root[NEXT]
+        entry[PREV], entry[NEXT] = self.root, first
+        first[PREV] = self.root[NEXT] = entry
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.counters['misses'] += 1
+                return None
+            if entry[EXPIRES] < time.time():
+                self._unlink_(entry)
+                del self.entries[key]
+                self.counters['expirations'] += 1
+                self.counters['misses'] += 1
+                return None
+            self._unlink_(entry)
+            self._push_(entry)
+            self.counters['hits'] += 1
+            return entry[VALUE]
+
+    def set(self, key, value, ttl=None):
+        expires = time.time() + min(ttl or self.ttl, self.ttl)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self._unlink_(entry)
+            elif len(self.entries) >= self.size:
+                last = self.root[PREV]
+                self._unlink_(last)
+                del self.entries[last[KEY]]
+                self.counters['evictions'] += 1
+            entry = [None, None, key, value, expires]
+            self.entries[key] = entry
+            self._push_(entry)
+
+    def delete(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self._unlink_(entry)
+
+    def purge(self, stale):
+        """Deletes the entries for which stale(key, value) is true, going
+        through all of them"""
+        with self.lock:
+            for key, entry in self.entries.items():
+                if stale(key, entry[VALUE]):
+                    self._unlink_(entry)
+                    del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.root[:] = [self.root, self.root, None, None, None]
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats['entries'] = len(self.entries)
+        return stats
+
+
+class CacheUnavailable(Exception):
+    pass
+
+
+class CircuitBreaker(object):
+    """Stops calling a failing service for reset seconds after failures
+    errors in a row, so requests don't each wait for a timeout meanwhile.
+    After that, calls go through again and the first error reopens it."""
+
+    def __init__(self, failures, reset):
+        self.failures = failures
+        self.reset = reset
+        self.lock = threading.Lock()
+        self.errors = 0
+        self.opened_at = None
+        self.counters = {
+            'opened': 0,
+            'rejected': 0,
+        }
+
+    def call(self, fun, *args):
+        with self.lock:
+            if self.opened_at is not None:
+                if time.time() - self.opened_at < self.reset:
+                    self.counters['rejected'] += 1
+                    raise CacheUnavailable("circuit open")
+        try:
+            r = fun(*args)
+        except redis.exceptions.RedisError, e:
+            with self.lock:
+                self.errors += 1
+                if self.errors >= self.failures:
+                    if self.opened_at is None:
+                        logger.error("Cache backend failing, not used for %ss: %s" % (
+                            self.reset, e
+                        ))
+                        self.counters['opened'] += 1
+                    self.opened_at = time.time()
+            raise CacheUnavailable(str(e))
+        with self.lock:
+            self.errors = 0
+            self.opened_at = None
+        return r
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats['open'] = self.opened_at is not None
+        return stats
+
+
+class RedisBackend(object):
+    """Redis through a process-wide connection pool, with timeouts on its
+    sockets and behind a CircuitBreaker"""
+
+    def __init__(self, host, port, db=0, socket_timeout=None,
+                 max_connections=None, failures=3, reset=10):
+        self.pool = redis.ConnectionPool(
+            max_connections=max_connections, host=host, port=port, db=db,
+            socket_timeout=socket_timeout
+        )
+        self.rd = redis.Redis(connection_pool=self.pool)
+        self.breaker = CircuitBreaker(failures, reset)
+
+    def get(self, key):
+        return self.breaker.call(self.rd.get, key)
+
+    def mget(self, keys):
+        return self.breaker.call(self.rd.mget, keys)
+
+    def setex(self, key, value, ttl):
+        self.breaker.call(self.rd.setex, key, value, ttl)
+
+    def _incr_(self, keys):
+        pipe = self.rd.pipeline(transaction=False)
+        for key in keys:
+            pipe.incr(key)
+        return pipe.execute()
+
+    def incr(self, keys):
+        self.breaker.call(self._incr_, keys)
+
+    def reset(self):
+        """Drops the pooled connections, which can't be shared with a
+        forked process"""
+        self.pool.disconnect()
+
+    def stats(self):
+        return {'type': 'redis', 'breaker': self.breaker.stats()}
+
+
+class MemoryBackend(object):
+    """Process memory, holding up to size entries. Only fit for a single
+    server process, as other processes never see its invalidations."""
+
+    def __init__(self, size):
+        self.entries = LRUCache(size, 86400)
+        self.lock = threading.Lock()
+        self.counters = {}
+
+    def get(self, key):
+        with self.lock:
+            if key in self.counters:
+                return str(self.counters[key])
+        return self.entries.get(key)
+
+    def mget(self, keys):
+        return [self.get(key) for key in keys]
+
+    def setex(self, key, value, ttl):
+        self.entries.set(key, value, ttl)
+
+    def incr(self, keys):
+        with self.lock:
+            for key in keys:
+                self.counters[key] = self.counters.get(key, 0) + 1
+
+    def reset(self):
+        pass
+
+    def stats(self):
+        stats = self.entries.stats()
+        stats['type'] = 'memory'
+        return stats
+
+
+def get_backend():
+    """The backend set by cache_backend on the [server] section, redis
+    (configured by the [redis] section) or memory"""
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                kind = get_option("server", "cache_backend", "redis")
+                if kind == "memory":
+                    _backend = MemoryBackend(
+                        get_option("server", "cache_memory_size", 10000)
+                    )
+                else:
+                    _backend = RedisBackend(
+                        get_option("redis", "host", "localhost"),
+                        get_option("redis", "port", 6379),
+                        get_option("redis", "db", 0),
+                        get_option("redis", "socket_timeout", 0.5),
+                        get_option("redis", "max_connections", 100),
+                        get_option("redis", "breaker_failures", 3),
+                        get_option("redis", "breaker_reset", 10),
+                    )
+    return _backend
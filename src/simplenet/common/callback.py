@@ -16,17 +16,84 @@
 # @author: Juliano Martinez (ncode), Locaweb.
 # @author: Luiz Ozaki, Locaweb.
 
+import time
+
 from simplenet.common.event import EventManager
 from simplenet.network_appliances.firewall import Net
-from simplenet.common.config import get_logger
+from simplenet.common.config import get_logger, get_option
+from simplenet.db.db_utils import remove_scoped_session
 
 logger = get_logger()
 
+ACK_BATCH_SIZE = get_option("event", "ack_batch_size", 500)
+ACK_BATCH_WINDOW = get_option("event", "ack_batch_window", 0.5)
+
+
+class AckBuffer(object):
+    """Policy acks sent by the agents, applied to the database with one
+    update and acknowledged to the broker with one multiple ack per batch.
+    A batch is applied once it holds size acks or its first ack waited for
+    window seconds."""
+
+    def __init__(self, size, window):
+        self.size = size
+        self.window = window
+        self.ids = []
+        self.messages = []
+        self.started_at = None
+
+    def add(self, id, message):
+        if not self.messages:
+            self.started_at = time.time()
+        self.ids.append(id)
+        self.messages.append(message)
+        if len(self.messages) >= self.size or \
+           time.time() - self.started_at >= self.window:
+            self.flush()
+
+    def flush(self):
+        if not self.messages:
+            return
+        ids, messages = self.ids, self.messages
+        self.ids, self.messages = [], []
+        try:
+            Net().policy_ack_many(ids)
+        except Exception:
+            logger.exception("Failed to ack %s policies, requeueing them" % len(ids))
+            for message in messages:
+                message.requeue()
+            return
+        finally:
+            # The consumer outlives any request, end its session per batch
+            remove_scoped_session()
+        logger.info("Acked %s policies" % len(ids))
+        # Messages are buffered in delivery order, acking the last one acks
+        # the whole batch
+        last = messages[-1]
+        last.channel.basic_ack(last.delivery_tag, multiple=True)
+
+
+_buffer = AckBuffer(ACK_BATCH_SIZE, ACK_BATCH_WINDOW)
+
+
 def on_message(body, message):
-    logger.info("Received ack for %s from %s" % (body.get("id"), body.get("device")))
-    fw = Net()
-    fw.policy_ack(body.get("id"))
+    if not body.get("resync"):
+        logger.debug("Received ack for %s from %s" % (body.get("id"), body.get("device")))
+        _buffer.add(body.get("id"), message)
+        return
+    # Acks received before the resync are applied first
+    _buffer.flush()
+    logger.info("Received resync request from %s at version %s" % (body.get("device"), body.get("version")))
+    try:
+        Net().firewall_sync({'name': body.get("device")})
+    except Exception, e:
+        logger.error("Failed to resync %s: %s" % (body.get("device"), e))
+    finally:
+        remove_scoped_session()
     message.ack()
 
 def callback_run():
-    EventManager().listen_event("simplenet", on_message)
+    EventManager().listen_event(
+        "simplenet", on_message, prefetch_count=ACK_BATCH_SIZE,
+        timeout=ACK_BATCH_WINDOW, on_timeout=_buffer.flush
+    )
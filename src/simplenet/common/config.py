@@ -67,6 +67,17 @@ def get_logger():
 
     return logger
 
+def get_option(cfg_section, option, default=None):
+    if not config.has_option(cfg_section, option):
+        return default
+    if isinstance(default, bool):
+        return config.getboolean(cfg_section, option)
+    if isinstance(default, int):
+        return config.getint(cfg_section, option)
+    if isinstance(default, float):
+        return config.getfloat(cfg_section, option)
+    return config.get(cfg_section, option)
+
 def section(cfg, cfg_section):
     r = {}
     for k in cfg.options(cfg_section):
@@ -18,82 +18,251 @@
 # @author: Juliano Martinez, Locaweb.
 
 import socket
+import threading
+import time
 
-from kombu import BrokerConnection, Exchange, Queue
+from functools import wraps
+from kombu import BrokerConnection, Exchange, Queue, Producer
 
-from simplenet.common.config import config, get_logger
+from simplenet.common.config import config, get_logger, get_option
 
 logger = get_logger()
 
+_publisher = None
+_publisher_lock = threading.Lock()
+_local = threading.local()
+
+
+def get_publisher():
+    global _publisher
+    if _publisher is None:
+        with _publisher_lock:
+            if _publisher is None:
+                _publisher = Publisher(
+                    config.get("event", "broker"),
+                    get_option("event", "pool_limit", 10)
+                )
+    return _publisher
+
+
+def reset_publisher():
+    """Forgets the publisher, whose connections can't be shared with a
+    forked process"""
+    global _publisher
+    _publisher = None
+
+
+class Publisher(object):
+    """Process-wide publisher keeping a pool of broker connections (each one
+    with its own channel) and the entities already declared on the broker.
+
+    The pool is built on kombu's Resource, which blocks on Queue/Lock, so the
+    waits cooperate with gevent once the server is monkey patched.
+    """
+
+    def __init__(self, url, limit):
+        self.pool = BrokerConnection(url).Pool(limit=limit)
+        self.declared = set()
+        self.lock = threading.Lock()
+        self.counters = {
+            'published': 0,
+            'errors': 0,
+            'reconnects': 0,
+            'latency_total': 0.0,
+            'latency_max': 0.0,
+            'latency_last': 0.0,
+        }
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+        published = stats['published']
+        stats['latency_avg'] = stats['latency_total'] / published if published else 0.0
+        return stats
+
+    def _on_connection_error(self, exc, interval):
+        logger.warn("Broker connection lost (%r), reconnecting" % exc)
+        with self.lock:
+            self.counters['reconnects'] += 1
+            self.declared.clear()
+
+    def _maybe_declare(self, entity, channel):
+        if isinstance(entity, Queue):
+            key = ('queue', entity.name, entity.exchange.name, entity.routing_key)
+        else:
+            key = ('exchange', entity.name)
+        if key not in self.declared:
+            entity(channel).declare()
+            self.declared.add(key)
+
+    def _run(self, exchange, fun):
+        with self.pool.acquire(block=True) as conn:
+            producer = Producer(conn.default_channel, exchange=exchange,
+                                serializer="json", auto_declare=False)
+            ensured = conn.ensure(producer, lambda: fun(producer),
+                                  errback=self._on_connection_error,
+                                  max_retries=3)
+            return ensured()
+
+    def publish(self, exchange, params, routing_key, declare=()):
+        def _publish(producer):
+            self._maybe_declare(exchange, producer.channel)
+            for entity in declare:
+                self._maybe_declare(entity, producer.channel)
+            producer.publish(params, routing_key=routing_key)
+
+        start = time.time()
+        try:
+            self._run(exchange, _publish)
+        except Exception:
+            with self.lock:
+                self.counters['errors'] += 1
+            raise
+        latency = time.time() - start
+        with self.lock:
+            self.counters['published'] += 1
+            self.counters['latency_total'] += latency
+            self.counters['latency_last'] = latency
+            self.counters['latency_max'] = max(self.counters['latency_max'], latency)
+        logger.debug("Published to %s:%s in %.4fs" % (exchange.name, routing_key, latency))
+
+    def declare(self, entity):
+        self._run(entity.exchange, lambda producer: self._maybe_declare(entity, producer.channel))
+
+    def unbind(self, queue):
+        def _unbind(producer):
+            bound = queue(producer.channel)
+            try:
+                bound.unbind()
+            except AttributeError:
+                bound.unbind_from(exchange=queue.exchange, routing_key=queue.routing_key)
+            self.declared.discard(('queue', queue.name, queue.exchange.name, queue.routing_key))
+
+        self._run(queue.exchange, _unbind)
+
+
+class EventBatch(object):
+    """Buffers the events raised while it is active and publishes them when
+    the outermost batch exits, keeping only the last event of each key.
+
+    Batches are greenlet local once the server is monkey patched, so each
+    request gets its own buffer.
+    """
+
+    def __enter__(self):
+        self.parent = getattr(_local, 'batch', None)
+        if self.parent is None:
+            self.order = []
+            self.entries = {}
+            _local.batch = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.parent is None:
+            del _local.batch
+            self.flush()
+
+    def add(self, key, fun, args, kwargs):
+        if key is None:
+            key = object()
+        if key not in self.entries:
+            self.order.append(key)
+        self.entries[key] = (fun, args, kwargs)
+
+    def flush(self):
+        if self.order:
+            logger.debug("Flushing %s buffered events" % len(self.order))
+        for key in self.order:
+            fun, args, kwargs = self.entries[key]
+            try:
+                fun(*args, **kwargs)
+            except Exception:
+                logger.exception("Failed to publish buffered event %s" % fun.__name__)
+        self.order = []
+        self.entries = {}
+
+
+def defer(key, fun, *args, **kwargs):
+    batch = getattr(_local, 'batch', None)
+    if batch is None:
+        return fun(*args, **kwargs)
+    batch.add(key, fun, args, kwargs)
+
+
+def batch_events(f):
+    @wraps(f)
+    def batched(*args, **kwargs):
+        with EventBatch():
+            return f(*args, **kwargs)
+    return batched
+
+
 class EventManager(object):
     def __init__(self):
         self.url = config.get("event", "broker")
 
     def raise_fanout_event(self, exchange, event_type, params, **kwargs):
+        defer(None, self._raise_fanout_event_, exchange, event_type, params, **kwargs)
+
+    def _raise_fanout_event_(self, exchange, event_type, params, **kwargs):
         logger.debug("Raising event %s with params: %s" % (event_type, params))
-        with BrokerConnection(self.url) as conn:
-            conn.ensure_connection()
+        publisher = get_publisher()
+        media_exchange = Exchange(
+                "dhcp:fanout:%s" % exchange,
+                type="fanout",
+                durable=True)
 
-            media_exchange = Exchange(
-                    "dhcp:fanout:%s" % exchange,
-                    type="fanout",
-                    durable=True)
+        if 'route' in kwargs:
+            routing_key = kwargs['route']
+        else:
+            queue = Queue(
+                    event_type,
+                    exchange=media_exchange,
+                    routing_key=event_type
+            )
 
-            if 'route' in kwargs:
-                routing_key = kwargs['route']
+            if params['action'] == 'new' or params['action'] == 'rebuild_queues':
+                publisher.declare(queue)
+                return
+            elif params['action'] == 'remove':
+                publisher.unbind(queue)
+                return
             else:
-                queue = Queue(
-                        event_type,
-                        exchange=media_exchange,
-                        routing_key=event_type
-                )
-
-                if params['action'] == 'new' or params['action'] == 'rebuild_queues':
-                    queue(conn.channel()).declare()
-                    return
-                elif params['action'] == 'remove':
-                    try:
-                        queue(conn.channel()).unbind()
-                    except AttributeError:
-                        queue(conn.channel()).unbind_from(exchange=media_exchange, routing_key=event_type)
-                    return
-                else:
-                    routing_key = event_type
-
-            with conn.Producer(exchange=media_exchange, serializer="json",
-                               routing_key=routing_key) as producer:
-                    logger.debug("Publishing %s" % params)
-                    producer.publish(params)
+                routing_key = event_type
 
+        publisher.publish(media_exchange, params, routing_key)
 
     def raise_event(self, event_type, params, **kwargs):
-        logger.debug("Raising event %s with params: %s" % (event_type, params))
-        with BrokerConnection(self.url) as conn:
-            conn.ensure_connection()
-
-            media_exchange = Exchange(
-                    "simplenet",
-                    type="direct",
-                    durable=True)
+        key = None
+        if params.get('zone_id'):
+            key = (event_type, params['zone_id'])
+        defer(key, self._raise_event_, event_type, params, **kwargs)
 
-            if 'route' in kwargs:
-                routing_key = kwargs['route']
-            else:
-                queue = Queue(
-                        event_type,
-                        exchange=media_exchange,
-                        routing_key=event_type
-                )
+    def _raise_event_(self, event_type, params, **kwargs):
+        logger.debug("Raising event %s with params: %s" % (event_type, params))
+        media_exchange = Exchange(
+                "simplenet",
+                type="direct",
+                durable=True)
 
-                queue(conn.channel()).declare()
-                routing_key = event_type
+        declare = []
+        if 'route' in kwargs:
+            routing_key = kwargs['route']
+        else:
+            declare.append(Queue(
+                    event_type,
+                    exchange=media_exchange,
+                    routing_key=event_type
+            ))
+            routing_key = event_type
 
-            with conn.Producer(exchange=media_exchange, serializer="json",
-                               routing_key=routing_key) as producer:
-                    logger.debug("Publishing %s" % params)
-                    producer.publish(params)
+        get_publisher().publish(media_exchange, params, routing_key, declare)
 
-    def listen_event(self, queue_name, callback):
+    def listen_event(self, queue_name, callback, prefetch_count=None,
+                     timeout=None, on_timeout=None):
+        """Consumes queue_name, calling callback for every message. With a
+        timeout, on_timeout is called whenever no message arrives for that
+        long."""
         with BrokerConnection(self.url) as conn:
             conn.ensure_connection()
 
@@ -111,8 +280,13 @@ class EventManager(object):
 
             logger.info("Listening for data...")
             with conn.Consumer([queue], callbacks=[callback]) as consumer:
+                if prefetch_count:
+                    consumer.qos(prefetch_count=prefetch_count)
                 while True:
-                    conn.drain_events()
+                    try:
+                        conn.drain_events(timeout=timeout)
+                    except socket.timeout:
+                        on_timeout()
 
     def bind_queue(self, queue_name, routing_key):
         with BrokerConnection(self.url) as conn:
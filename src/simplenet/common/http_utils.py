@@ -17,12 +17,14 @@
 # @author: Juliano Martinez (ncode), Locaweb.
 # @author: Luiz Ozaki, Locaweb.
 
-import redis
+import types
 
 from functools import wraps
 from bottle import response, request, abort
 
-from simplenet.common.config import get_logger
+from simplenet.common.cache import LRUCache, CacheUnavailable, get_backend
+from simplenet.common.config import get_logger, get_option
+from simplenet.exceptions import InvalidQueryParameter
 import hashlib
 
 try:
@@ -32,19 +34,101 @@ except ImportError:
 
 logger = get_logger()
 
+LIST_LIMIT_MAX = get_option("server", "list_limit_max", 1000)
+BULK_LIMIT = get_option("server", "bulk_limit", 10000)
+CACHE_LOCAL_SIZE = get_option("server", "cache_local_size", 1000)
+CACHE_LOCAL_TTL = get_option("server", "cache_local_ttl", 30)
+CACHE_VERSION_TTL = get_option("server", "cache_version_ttl", 1.0)
+
+
+class JSONReply(str):
+    """A reply already serialized, sent as it is by reply_json.
+    next_after: the X-Next-After of the page it holds, if any"""
+    next_after = None
+
+
+def next_after(r, limit):
+    """Id the page after r starts from, None when r is the last page"""
+    if limit and type(r) is list and len(r) == limit:
+        return str(r[-1]['id'])
+    return None
+
 
 def reply_json(f):
     @wraps(f)
     def json_dumps(*args, **kwargs):
         r = f(*args, **kwargs)
+        if isinstance(r, types.GeneratorType):
+            response.content_type = "application/x-ndjson; charset=UTF-8"
+            return ("%s\n" % dumps(x) for x in r)
         response.content_type = "application/json; charset=UTF-8"
         if r and type(r) in (dict, list, tuple):
             return dumps(r)
-        if r and type(r) is str:
+        if r and isinstance(r, str):
             return r
     return json_dumps
 
 
+def list_query():
+    """Reads the list arguments from the query string: limit and after page
+    through the entries by id, stream=true (or an application/x-ndjson
+    Accept header) streams them one per line and any other argument
+    filters on the column with the same name"""
+    query = {'filters': {}}
+    for key, value in request.query.iteritems():
+        if key == 'limit':
+            try:
+                query['limit'] = int(value)
+            except ValueError:
+                raise InvalidQueryParameter(key)
+            if not 0 < query['limit'] <= LIST_LIMIT_MAX:
+                raise InvalidQueryParameter(key)
+        elif key == 'after':
+            query['after'] = value
+        elif key == 'stream':
+            query['stream'] = value.lower() in ('1', 'true', 'yes')
+        else:
+            query['filters'][key] = value
+    if 'application/x-ndjson' in request.headers.get('Accept', ''):
+        query['stream'] = True
+    return query
+
+
+def paginated(f):
+    """Calls a list route with the arguments from list_query and points
+    to the next page through the X-Next-After header"""
+    @wraps(f)
+    def paginate(*args, **kwargs):
+        query = list_query()
+        kwargs.update(query)
+        r = f(*args, **kwargs)
+        if isinstance(r, JSONReply):
+            after = r.next_after
+        else:
+            after = next_after(r, query.get('limit'))
+        if after:
+            response.set_header('X-Next-After', after)
+        return r
+    return paginate
+
+
+def bulk_input():
+    """Reads the JSON list of a bulk request, aborting on an empty body, on
+    anything else than a list or on more than BULK_LIMIT entries"""
+    data = request.body.read()
+    if not data:
+        abort(400, 'No data received')
+    try:
+        data = loads(data)
+    except ValueError:
+        abort(400, 'Error: invalid JSON')
+    if type(data) is not list:
+        abort(400, 'Error: a list of entries is expected')
+    if len(data) > BULK_LIMIT:
+        abort(400, 'Error: at most %s entries are accepted' % BULK_LIMIT)
+    return data
+
+
 def create_manager(network_appliance):
     _module_ = "simplenet.network_appliances.%s" % network_appliance
     module = __import__(_module_)
@@ -105,33 +189,136 @@ def validate_input(src="query", *vargs, **vkwargs):
         return validate
     return proxy
 
-def clear_cache(rd=None):
-    # TODO: Better cache
-    if not rd:
-        rd = redis.Redis()
+CACHE_PREFIX = "simplenet.cache"
+
+# Resources whose entries carry data of other resources, like the vlan name
+# of a subnet or the ips of an interface. Their cached replies hold the
+# generation of those resources as well.
+CACHE_DEPENDENCIES = {
+    'zones': ('datacenters',),
+    'vlans': ('zones',),
+    'subnets': ('vlans', 'ips'),
+    'ips': ('subnets', 'interfaces'),
+    'interfaces': ('ips', 'vlans', 'switches'),
+    'anycastips': ('anycasts',),
+    'firewalls': ('zones',),
+    'routers': ('zones',),
+}
+
+_dependencies = {}
+
+# Serialized replies by cache key, and the generations read from Redis by
+# resource. Generations are only kept for CACHE_VERSION_TTL, which bounds
+# how long a change made through another process can go unseen.
+_local = LRUCache(CACHE_LOCAL_SIZE, CACHE_LOCAL_TTL)
+_generations = LRUCache(CACHE_LOCAL_SIZE, CACHE_VERSION_TTL)
+_counters = {
+    'backend_hits': 0,
+    'misses': 0,
+    'errors': 0,
+}
+
+
+def cache_stats():
+    stats = dict(_counters)
+    stats['local'] = _local.stats()
+    stats['generations'] = _generations.stats()
+    stats['backend'] = get_backend().stats()
+    return stats
+
+
+def cache_dependencies(resource):
+    """resource and every resource its entries depend on, sorted"""
+    if resource not in _dependencies:
+        found, pending = set(), [resource]
+        while pending:
+            current = pending.pop()
+            if current not in found:
+                found.add(current)
+                pending.extend(CACHE_DEPENDENCIES.get(current, ()))
+        _dependencies[resource] = sorted(found)
+    return _dependencies[resource]
+
+
+def _version_key_(resource=None):
+    if resource:
+        return "%s.version.%s" % (CACHE_PREFIX, resource)
+    return "%s.version" % CACHE_PREFIX
+
+
+def clear_cache(*resources, **kwargs):
+    """Invalidates the cached replies of resources by bumping their
+    generation, or every cached reply when no resource is given. Entries
+    of the old generations are never read again and expire on their ttl."""
+    backend = kwargs.get('backend') or get_backend()
     try:
-        rd.delete(*rd.keys("simplenet.cache.*"))
-    except redis.exceptions.ResponseError:
-        pass
+        backend.incr([_version_key_(resource) for resource in resources or (None,)])
+    except CacheUnavailable, e:
+        _counters['errors'] += 1
+        logger.error("Cache invalidation of %s failed: %s" % (resources, e))
+    _generations.clear()
+
+def _generation_(backend, resource):
+    generation = _generations.get(resource)
+    if generation is None:
+        keys = [_version_key_()] + [
+            _version_key_(dependency) for dependency in cache_dependencies(resource)
+        ]
+        generation = repr(backend.mget(keys))
+        _generations.set(resource, generation)
+    return generation
+
 
-def cache(ttl=300, rd=None):
-    if not rd:
-        rd = redis.Redis()
+def cache(resource=None, ttl=300, backend=None):
+    """Caches the replies of a route for ttl seconds under a key holding
+    the generation of resource and of its dependencies, so they are left
+    behind as soon as any of them changes. Without a resource, the one
+    named by the resource argument of the route is used.
+
+    Replies are kept serialized, in process for up to CACHE_LOCAL_TTL and
+    on the backend, get_backend() unless one is given, and returned as
+    JSONReply, so hits skip both JSON passes."""
     def proxy(f):
         @wraps(f)
         def caching(*args, **kwargs):
-            _hash = "simplenet.cache.%s-%s" % (f.__name__, hashlib.md5("%s%s" % (
-                repr(args[1:]),
-                repr(kwargs)
-            )).hexdigest())
+            if kwargs.get('stream'):
+                return f(*args, **kwargs)
+            _backend = backend or get_backend()
+            name = resource or kwargs.get('resource')
             try:
-                cache = rd.get(_hash)
-                if not cache:
-                    cache = dumps(f(*args, **kwargs))
-                    rd.setex(_hash, cache, ttl)
-                return loads(cache)
-            except Exception, e:
+                _hash = "%s.%s.%s-%s" % (CACHE_PREFIX, name, f.__name__, hashlib.md5(
+                    "%s%s%s" % (_generation_(_backend, name), repr(args),
+                                repr(sorted(kwargs.items())))
+                ).hexdigest())
+            except CacheUnavailable:
+                _counters['errors'] += 1
                 return f(*args, **kwargs)
+            reply = _local.get(_hash)
+            if reply is not None:
+                return reply
+            try:
+                cached = _backend.get(_hash)
+            except CacheUnavailable:
+                _counters['errors'] += 1
+                cached = None
+            if cached is not None:
+                _counters['backend_hits'] += 1
+                after, body = cached.split('\n', 1)
+                reply = JSONReply(body)
+                reply.next_after = after or None
+                _local.set(_hash, reply, ttl)
+                return reply
+            _counters['misses'] += 1
+            r = f(*args, **kwargs)
+            # Empty replies are sent without a body, like reply_json does
+            reply = JSONReply(dumps(r) if r else '')
+            reply.next_after = next_after(r, kwargs.get('limit'))
+            _local.set(_hash, reply, ttl)
+            try:
+                _backend.setex(_hash, "%s\n%s" % (reply.next_after or '', reply), ttl)
+            except CacheUnavailable:
+                _counters['errors'] += 1
+            return reply
         return caching
     return proxy
 
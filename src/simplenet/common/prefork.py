@@ -0,0 +1,188 @@
+# Copyright 2012 Locaweb.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+# @author: Juliano Martinez (ncode), Locaweb.
+# @author: Luiz Ozaki, Locaweb.
+
+"""Prefork server: a master process binds the listening socket and forks
+gevent workers serving it, plus the worker consuming the agents acks, and
+replaces any of them that dies.
+
+Signals handled by the master:
+
+* TERM, INT: stops the workers, letting the running requests finish for
+  up to graceful_timeout, and exits
+* HUP: starts a new set of workers and gracefully stops the old ones,
+  without closing the listening socket. Workers are forked from the master,
+  so changes to the code or configuration still need a restart."""
+
+import errno
+import os
+import signal
+import socket
+import time
+
+import gevent
+
+from gevent.pool import Pool
+from gevent.pywsgi import WSGIServer
+
+try:
+    from gevent import signal_handler as gevent_signal
+except ImportError:
+    # gevent < 1.5
+    from gevent import signal as gevent_signal
+
+from simplenet.common.config import get_logger
+
+logger = get_logger()
+
+
+def listen(host, port, backlog=1024):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    return sock
+
+
+def serve(listener, app, connections, graceful_timeout):
+    """Serves app on listener until TERM, then waits for up to
+    graceful_timeout for the running requests"""
+    server = WSGIServer(listener, app, spawn=Pool(connections))
+    gevent_signal(signal.SIGTERM, server.stop, graceful_timeout)
+    server.serve_forever()
+
+
+class Worker(object):
+    """kind: name of the worker on the logs
+    target: what the worker process runs, it exits when target returns"""
+
+    def __init__(self, kind, target):
+        self.kind = kind
+        self.target = target
+        self.pid = None
+        self.started_at = None
+
+
+class Master(object):
+    """Forks and supervises the workers built by workers(), a function
+    returning a new list of Worker. after_fork runs first on every worker
+    process, to drop whatever it can't share with the master, like pooled
+    connections."""
+
+    def __init__(self, workers, after_fork=None, graceful_timeout=30):
+        self.build = workers
+        self.after_fork = after_fork
+        self.graceful_timeout = graceful_timeout
+        self.workers = {}
+        self.retiring = {}
+        self.signals = []
+
+    def _signal_(self, signum, frame):
+        self.signals.append(signum)
+
+    def spawn(self, worker):
+        worker.started_at = time.time()
+        pid = gevent.fork()
+        if pid:
+            worker.pid = pid
+            self.workers[pid] = worker
+            logger.info("Started %s worker %s" % (worker.kind, pid))
+            return pid
+        # Worker process
+        status = 0
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            if self.after_fork:
+                self.after_fork()
+            worker.target()
+        except:
+            logger.exception("%s worker %s failed" % (worker.kind, os.getpid()))
+            status = 1
+        os._exit(status)
+
+    def kill(self, workers, signum):
+        for pid in workers:
+            try:
+                os.kill(pid, signum)
+            except OSError, e:
+                if e.errno != errno.ESRCH:
+                    raise
+
+    def reap(self):
+        """Collects the exited workers, returning the ones to replace"""
+        exited = []
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError, e:
+                if e.errno == errno.ECHILD:
+                    break
+                raise
+            if not pid:
+                break
+            if pid in self.retiring:
+                self.retiring.pop(pid)
+                continue
+            worker = self.workers.pop(pid, None)
+            if worker:
+                logger.error("%s worker %s exited with status %s" % (
+                    worker.kind, pid, status
+                ))
+                exited.append(worker)
+        return exited
+
+    def reload(self):
+        logger.info("Reloading workers")
+        old = self.workers
+        self.workers = {}
+        for worker in self.build():
+            self.spawn(worker)
+        self.retiring.update(old)
+        self.kill(old, signal.SIGTERM)
+
+    def stop(self):
+        logger.info("Stopping workers")
+        self.retiring.update(self.workers)
+        self.workers = {}
+        self.kill(self.retiring, signal.SIGTERM)
+        limit = time.time() + self.graceful_timeout
+        while self.retiring and time.time() < limit:
+            self.reap()
+            time.sleep(0.1)
+        self.kill(self.retiring, signal.SIGKILL)
+
+    def run(self):
+        for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+            signal.signal(signum, self._signal_)
+        for worker in self.build():
+            self.spawn(worker)
+        while True:
+            while self.signals:
+                signum = self.signals.pop(0)
+                if signum == signal.SIGHUP:
+                    self.reload()
+                else:
+                    self.stop()
+                    return
+            for worker in self.reap():
+                # Don't respawn in a loop a worker failing on start
+                if time.time() - worker.started_at < 1:
+                    time.sleep(1)
+                self.spawn(Worker(worker.kind, worker.target))
+            time.sleep(0.5)
@@ -0,0 +1,100 @@
+# Copyright 2012 Locaweb.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+# @author: Juliano Martinez (ncode), Locaweb.
+# @author: Luiz Ozaki, Locaweb.
+
+"""Free address tracking for subnet allocations.
+
+The free addresses of a subnet are kept as sorted, disjoint intervals and
+cached by subnet along with the subnet allocation_version they match.
+Every change to the ips of a subnet bumps that version while holding the
+subnet row lock, so a cached entry is only used while nothing else touched
+the subnet, and is rebuilt from the subnet ips otherwise."""
+
+from ipaddr import IPNetwork
+
+from simplenet.db.models import value_key
+
+CACHE_SIZE = 10000
+
+_cache = {}
+
+
+class FreeRanges(object):
+
+    def __init__(self, cidr, used):
+        """cidr: the subnet, its network, gateway and (ipv4) broadcast
+        addresses are never handed out
+        used: keys of the addresses already taken"""
+        network = IPNetwork(cidr)
+        self.version = network.version
+        first, last = int(network.network), int(network.broadcast)
+        reserved = set()
+        if last - first > 1:
+            reserved.update([first, int(network.ip) + 1])
+            if self.version == 4:
+                reserved.add(last)
+        taken = sorted(reserved.union(int(key[1:], 16) for key in used))
+        self.starts, self.ends = [], []
+        self.size = 0
+        start = first
+        for value in taken:
+            if value < start or value > last:
+                continue
+            if value > start:
+                self._append_(start, value - 1)
+            start = value + 1
+        if start <= last:
+            self._append_(start, last)
+
+    def _append_(self, start, end):
+        self.starts.append(start)
+        self.ends.append(end)
+        self.size += end - start + 1
+
+    def take(self, count):
+        """Removes and returns the keys of the count lowest free addresses"""
+        keys = []
+        while count and self.starts:
+            start, end = self.starts[0], self.ends[0]
+            n = min(count, end - start + 1)
+            keys.extend(value_key(self.version, start + i) for i in xrange(n))
+            if start + n > end:
+                del self.starts[0]
+                del self.ends[0]
+            else:
+                self.starts[0] = start + n
+            self.size -= n
+            count -= n
+        return keys
+
+
+def cached(subnet_id, version):
+    """The free ranges of subnet_id if the cached ones match version"""
+    entry = _cache.get(subnet_id)
+    if entry and entry[0] == version:
+        return entry[1]
+    return None
+
+
+def store(subnet_id, version, ranges):
+    if len(_cache) >= CACHE_SIZE:
+        _cache.clear()
+    _cache[subnet_id] = (version, ranges)
+
+
+def discard(subnet_id):
+    _cache.pop(subnet_id, None)
@@ -16,7 +16,11 @@
 # @author: Juliano Martinez (ncode), Locaweb.
 # @author: Luiz Ozaki, Locaweb.
 
-from sqlalchemy.orm import sessionmaker
+import types
+
+from functools import wraps
+
+from sqlalchemy.orm import sessionmaker, scoped_session
 from simplenet.db import models
 from simplenet.common.config import get_logger
 
@@ -24,6 +28,7 @@ logger = get_logger()
 
 _engine = models.engine
 _maker = None
+_scoped = None
 
 def get_database_session(autocommit=True, expire_on_commit=True):
     global _maker, _engine
@@ -34,6 +39,43 @@ def get_database_session(autocommit=True, expire_on_commit=True):
                               expire_on_commit=expire_on_commit)
     return _maker()
 
+def get_scoped_session():
+    """The session of the running greenlet (or thread), shared by every
+    manager created while handling a request. request_session ends it
+    along with the request."""
+    global _scoped
+    if not _scoped:
+        get_database_session()
+        _scoped = scoped_session(_maker)
+    return _scoped
+
+def remove_scoped_session():
+    if _scoped:
+        _scoped.remove()
+
+def _remove_after_(r):
+    try:
+        for chunk in r:
+            yield chunk
+    finally:
+        remove_scoped_session()
+
+def request_session(f):
+    """Bottle plugin closing the session of a request once it is handled,
+    or once its streamed reply is sent"""
+    @wraps(f)
+    def scoped(*args, **kwargs):
+        try:
+            r = f(*args, **kwargs)
+        except:
+            remove_scoped_session()
+            raise
+        if isinstance(r, types.GeneratorType):
+            return _remove_after_(r)
+        remove_scoped_session()
+        return r
+    return scoped
+
 def unregister_database_models(base):
     global _engine
     assert _engine
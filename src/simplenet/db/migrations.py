@@ -0,0 +1,238 @@
+# Copyright 2012 Locaweb.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+# @author: Juliano Martinez (ncode), Locaweb.
+# @author: Luiz Ozaki, Locaweb.
+
+"""Schema migrations. create_all only creates missing tables, so changes
+to existing tables are applied here as numbered steps, recorded on the
+schema_version table. Steps check the live schema through the inspector
+before changing it, as databases created by create_all already have the
+current models."""
+
+import re
+import time
+
+from sqlalchemy import Column, Integer, MetaData, Table, select, bindparam
+from sqlalchemy.engine.reflection import Inspector
+
+from simplenet.common.config import get_logger
+from simplenet.db import models
+from simplenet.db.models import (
+    Base, Zone, Vlan, Subnet, Ip, Interface, Firewall, Router, Anycast,
+    Anycastip, Policy, address_key, cidr_range
+)
+
+logger = get_logger()
+
+# Rows read and updated at a time by backfills
+BACKFILL_CHUNK_SIZE = 1000
+
+metadata = MetaData()
+schema_version = Table('schema_version', metadata,
+    Column('version', Integer(), primary_key=True),
+    Column('applied_at', Integer()),
+)
+
+
+def _create_missing_indexes_(conn):
+    """Creates the indexes declared on the models which are missing from
+    the database. Indexes already covering the same columns under another
+    name, like the ones MySQL creates for foreign keys, are kept."""
+    inspector = Inspector.from_engine(conn)
+    for table in Base.metadata.sorted_tables:
+        existing = inspector.get_indexes(table.name)
+        names = set(index['name'] for index in existing)
+        columns = set(tuple(index['column_names']) for index in existing)
+        live = set(column['name'] for column in inspector.get_columns(table.name))
+        for index in table.indexes:
+            if index.name in names:
+                continue
+            if tuple(column.name for column in index.columns) in columns:
+                continue
+            if not live.issuperset(column.name for column in index.columns):
+                # The columns come in a later step
+                continue
+            logger.info("Creating index %s on %s" % (index.name, table.name))
+            index.create(conn)
+
+
+def _add_missing_columns_(conn):
+    """Adds the model columns missing from the database, as nullable
+    columns to be filled by the step adding them"""
+    inspector = Inspector.from_engine(conn)
+    for table in Base.metadata.sorted_tables:
+        live = set(column['name'] for column in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name in live:
+                continue
+            logger.info("Adding column %s to %s" % (column.name, table.name))
+            conn.execute("ALTER TABLE %s ADD COLUMN %s %s" % (
+                table.name, column.name, column.type.compile(dialect=conn.dialect)
+            ))
+
+
+def _backfill_(conn, table, source, values, pending):
+    """Fills the columns returned by values(source value) on the rows where
+    the pending column is still NULL, a chunk at a time. Rows whose source
+    can't be converted are logged and left as they are."""
+    last = ''
+    while True:
+        rows = conn.execute(
+            select([table.c.id, table.c[source]]).where(
+                (pending == None) & (table.c.id > last)
+            ).order_by(table.c.id).limit(BACKFILL_CHUNK_SIZE)
+        ).fetchall()
+        if not rows:
+            break
+        last = rows[-1][0]
+        updates = []
+        for id, value in rows:
+            try:
+                update = values(value)
+            except ValueError:
+                logger.warning("Can't convert %s %s of %s %s" % (
+                    source, value, table.name, id
+                ))
+                continue
+            updates.append(dict(
+                [('_id', id)] + [('_%s' % key, val) for key, val in update.iteritems()]
+            ))
+        if not updates:
+            continue
+        columns = [key[1:] for key in updates[0] if key != '_id']
+        conn.execute(
+            table.update().where(table.c.id == bindparam('_id')).values(
+                dict((key, bindparam('_%s' % key)) for key in columns)
+            ), updates
+        )
+
+
+def _add_addresses_(conn):
+    """Stores the range of subnets and anycasts and the address of ips and
+    anycastips as ordered keys, see models.address_key"""
+    _add_missing_columns_(conn)
+    _create_missing_indexes_(conn)
+    ranges = lambda cidr: dict(zip(('net_start', 'net_end'), cidr_range(cidr)))
+    addresses = lambda ip: {'address': address_key(ip)}
+    for table in (Subnet.__table__, Anycast.__table__):
+        _backfill_(conn, table, 'cidr', ranges, table.c.net_start)
+    for table in (Ip.__table__, Anycastip.__table__):
+        _backfill_(conn, table, 'ip', addresses, table.c.address)
+
+
+# (version, description, step) in the order they are applied
+MIGRATIONS = (
+    (1, "foreign key and policy owner indexes", _create_missing_indexes_),
+    (2, "address keys of subnets, anycasts and ips", _add_addresses_),
+    (3, "subnet allocation versions", _add_missing_columns_),
+)
+
+
+def current_version(conn):
+    schema_version.create(conn, checkfirst=True)
+    version = conn.execute(
+        select([schema_version.c.version]).order_by(
+            schema_version.c.version.desc()
+        ).limit(1)
+    ).scalar()
+    return version or 0
+
+
+def migrate(engine=None):
+    """Applies the pending steps, each one in its own transaction, and
+    returns the resulting schema version"""
+    engine = engine or models.engine
+    conn = engine.connect()
+    try:
+        version = current_version(conn)
+        for step_version, description, step in MIGRATIONS:
+            if step_version <= version:
+                continue
+            logger.info("Migrating schema to version %s: %s" % (
+                step_version, description
+            ))
+            trans = conn.begin()
+            try:
+                step(conn)
+                conn.execute(schema_version.insert(), version=step_version,
+                             applied_at=int(time.time()))
+                trans.commit()
+            except:
+                trans.rollback()
+                logger.exception("Migration to version %s failed" % step_version)
+                raise
+            version = step_version
+        return version
+    finally:
+        conn.close()
+
+
+# Queries behind the list-by-parent, policy and address lookups
+HOT_QUERIES = (
+    ('zones by datacenter', Zone.__table__, Zone.datacenter_id == 'x'),
+    ('vlans by zone', Vlan.__table__, Vlan.zone_id == 'x'),
+    ('subnets by vlan', Subnet.__table__, Subnet.vlan_id == 'x'),
+    ('ips by subnet', Ip.__table__, Ip.subnet_id == 'x'),
+    ('ips by interface', Ip.__table__, Ip.interface_id == 'x'),
+    ('interfaces by switch', Interface.__table__, Interface.switch_id == 'x'),
+    ('interfaces by vlan', Interface.__table__, Interface.vlan_id == 'x'),
+    ('firewalls by zone', Firewall.__table__, Firewall.zone_id == 'x'),
+    ('routers by zone', Router.__table__, Router.zone_id == 'x'),
+    ('anycastips by anycast', Anycastip.__table__, Anycastip.anycast_id == 'x'),
+    ('policies by owner', Policy.__table__,
+     (Policy.owner_type == 'x') & (Policy.owner_id == 'x')),
+    ('subnet by ip', Subnet.__table__,
+     (Subnet.net_start <= address_key('10.0.0.1')) &
+     (Subnet.net_end >= address_key('10.0.0.1'))),
+    ('ips by cidr', Ip.__table__,
+     Ip.address.between(*cidr_range('10.0.0.0/24'))),
+)
+
+
+def _explain_(conn, statement):
+    """Returns the index used by statement, None on a table scan"""
+    compiled = statement.compile(dialect=conn.dialect)
+    if conn.dialect.positional:
+        params = [compiled.params[key] for key in compiled.positiontup]
+    else:
+        params = compiled.params
+    if conn.dialect.name == 'sqlite':
+        plan = conn.execute("EXPLAIN QUERY PLAN %s" % compiled, params)
+        for row in plan:
+            match = re.search(r"USING (?:COVERING )?INDEX (\S+)", list(row)[-1])
+            if match:
+                return match.group(1)
+        return None
+    plan = conn.execute("EXPLAIN %s" % compiled, params)
+    for row in plan:
+        if row['key']:
+            return row['key']
+    return None
+
+
+def explain_hot_queries(engine=None):
+    """Returns (query, index) for each of HOT_QUERIES, index being None
+    when the database scans the table"""
+    engine = engine or models.engine
+    conn = engine.connect()
+    try:
+        result = []
+        for name, table, criteria in HOT_QUERIES:
+            statement = select([table]).where(criteria)
+            result.append((name, _explain_(conn, statement)))
+        return result
+    finally:
+        conn.close()
@@ -18,14 +18,15 @@
 
 import uuid
 
-from ipaddr import IPv4Network, IPv4Address, IPv6Network, IPv6Address, IPNetwork, IPAddress
+from ipaddr import IPv4Network, IPv6Network, IPNetwork, IPAddress
 
-from sqlalchemy import event, Column, Integer, String, Boolean, create_engine, ForeignKey
+from sqlalchemy import event, Column, Integer, String, Boolean, Text, create_engine, ForeignKey
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.schema import UniqueConstraint
+from sqlalchemy.schema import UniqueConstraint, Index
 from sqlalchemy.orm import relationship, backref
 
-from simplenet.common.config import config
+from simplenet.common.config import config, get_option
+from simplenet.db.pool import TimedQueuePool, ping_on_checkout
 
 Base = declarative_base()
 
@@ -33,6 +34,35 @@ def new_model(model_name):
     model = globals()[model_name]
     return model, model.__tablename__
 
+def cidr_gateway(cidr):
+    return str(IPNetwork(cidr).ip+1)
+
+def cidr_network(cidr):
+    return IPNetwork(cidr).with_netmask
+
+def value_key(version, value):
+    """Key of the address numbered value in the family version"""
+    if version == 4:
+        return '4%08x' % value
+    return '6%032x' % value
+
+def address_key(address):
+    """Fixed width key of an address, its family followed by its value in
+    hex, so keys of the same family sort like the addresses do and keys
+    of different families never fall in the same range"""
+    address = IPAddress(address)
+    return value_key(address.version, int(address))
+
+def cidr_range(cidr):
+    """Keys of the first and last addresses of cidr"""
+    network = IPNetwork(cidr)
+    return (value_key(network.version, int(network.network)),
+            value_key(network.version, int(network.broadcast)))
+
+def key_address(key):
+    """The address of a key made by address_key"""
+    return str(IPAddress(int(key[1:], 16), version=int(key[0])))
+
 class Prober(Base):
 
     __tablename__ = 'prober'
@@ -66,7 +96,7 @@ class Zone(Base):
     id = Column(String(36), primary_key=True)
     name = Column(String(255), unique=True)
     description = Column(String(255))
-    datacenter_id = Column(String(36), ForeignKey('datacenters.id'))
+    datacenter_id = Column(String(36), ForeignKey('datacenters.id'), index=True)
     datacenter = relationship('Datacenter')
 
     def __init__(self, name, datacenter_id, description=''):
@@ -133,10 +163,11 @@ class Firewall(Base):
     name = Column(String(255), unique=True)
     status = Column(Boolean())
     description = Column(String(255))
-    zone_id = Column(String(36), ForeignKey('zones.id'))
+    zone_id = Column(String(36), ForeignKey('zones.id'), index=True)
     mac = Column(String(30))
     address = Column(String(255))
     anycasts_to_firewalls = relationship('Anycasts_to_Firewall', cascade='all, delete-orphan')
+    ruleset = relationship('FirewallRuleset', uselist=False, cascade='all, delete-orphan')
     zone = relationship('Zone')
 
     def __init__(self, name, zone_id, mac, status, description=''):
@@ -178,6 +209,22 @@ class Firewall(Base):
             'status': self.status,
         }
 
+class FirewallRuleset(Base):
+
+    __tablename__ = 'firewall_rulesets'
+
+    firewall_id = Column(String(36), ForeignKey('firewalls.id'), primary_key=True)
+    version = Column(Integer())
+    state = Column(Text(4294967295))
+
+    def __init__(self, firewall_id):
+        self.firewall_id = firewall_id
+        self.version = 0
+        self.state = None
+
+    def __repr__(self):
+       return "<FirewallRuleset('%s','%s')>" % (self.firewall_id, self.version)
+
 class Router(Base):
 
     __tablename__ = 'routers'
@@ -186,7 +233,7 @@ class Router(Base):
     name = Column(String(255), unique=True)
     status = Column(Boolean())
     description = Column(String(255))
-    zone_id = Column(String(36), ForeignKey('zones.id'))
+    zone_id = Column(String(36), ForeignKey('zones.id'), index=True)
     mac = Column(String(30))
     address = Column(String(255))
     zone = relationship('Zone')
@@ -274,8 +321,8 @@ class Interface(Base):
     __tablename__ = 'interfaces'
 
     id = Column(String(36), primary_key=True, unique=True)
-    switch_id = Column(String(36), ForeignKey('switches.id'))
-    vlan_id = Column(String(36), ForeignKey('vlans.id'))
+    switch_id = Column(String(36), ForeignKey('switches.id'), index=True)
+    vlan_id = Column(String(36), ForeignKey('vlans.id'), index=True)
     status = Column(String(100))
     name = Column(String(255))
     hostname = Column(String(255))
@@ -317,7 +364,7 @@ class Vlan(Base):
     type = Column(String(100))
     vlan_num = Column(Integer())
     description = Column(String(255))
-    zone_id = Column(String(36), ForeignKey('zones.id'))
+    zone_id = Column(String(36), ForeignKey('zones.id'), index=True)
     zone = relationship('Zone')
 
     def __init__(self, name, zone_id, type, vlan_num, description=''):
@@ -371,21 +418,28 @@ class Subnet(Base):
 
     id = Column(String(36), primary_key=True)
     cidr = Column(String(255), unique=True)
+    net_start = Column(String(33))
+    net_end = Column(String(33))
+    allocation_version = Column(Integer())
     description = Column(String(255))
-    vlan_id = Column(String(36), ForeignKey('vlans.id'))
+    vlan_id = Column(String(36), ForeignKey('vlans.id'), index=True)
     vlan = relationship('Vlan', backref="subnet")
     ip = relationship('Ip')
 
+    __table_args__ = (Index("ix_subnets_net_start_net_end", "net_start", "net_end"),)
+
     def __init__(self, cidr, vlan_id, description=''):
         self.id = str(uuid.uuid4())
         self.cidr = cidr
+        self.net_start, self.net_end = cidr_range(cidr)
+        self.allocation_version = 0
         self.vlan_id = vlan_id
 
     def gateway(self):
-        return str(IPNetwork(self.cidr).ip+1)
+        return cidr_gateway(self.cidr)
 
     def network(self):
-        return IPNetwork(self.cidr).with_netmask
+        return cidr_network(self.cidr)
 
     def to_ip(self):
         if IPNetwork(self.cidr).version == 4:
@@ -394,10 +448,7 @@ class Subnet(Base):
             return IPv6Network(self.cidr)
 
     def contains(self, ip):
-        if IPAddress(ip).version == 4:
-            return self.to_ip().Contains(IPv4Address(ip))
-        else:
-            return self.to_ip().Contains(IPv6Address(ip))
+        return self.net_start <= address_key(ip) <= self.net_end
 
     def __repr__(self):
        return "<Subnet('%s','%s')>" % (self.id, self.cidr)
@@ -426,15 +477,17 @@ class Ip(Base):
 
     id = Column(String(36), primary_key=True)
     ip = Column(String(255), unique=True)
+    address = Column(String(33), index=True)
     description = Column(String(255))
-    subnet_id = Column(String(36), ForeignKey('subnets.id'))
+    subnet_id = Column(String(36), ForeignKey('subnets.id'), index=True)
     subnet = relationship('Subnet')
-    interface_id = Column(String(36), ForeignKey('interfaces.id'))
+    interface_id = Column(String(36), ForeignKey('interfaces.id'), index=True)
     interface = relationship("Interface", collection_class=set, backref=backref("ips", collection_class=set))
 
     def __init__(self, ip, subnet_id, description=''):
         self.id = str(uuid.uuid4())
         self.ip = ip
+        self.address = address_key(ip)
         self.subnet_id = subnet_id
 
     def __repr__(self):
@@ -466,11 +519,16 @@ class Anycast(Base):
 
     id = Column(String(36), primary_key=True)
     cidr = Column(String(255), unique=True)
+    net_start = Column(String(33))
+    net_end = Column(String(33))
     description = Column(String(255))
 
+    __table_args__ = (Index("ix_anycasts_net_start_net_end", "net_start", "net_end"),)
+
     def __init__(self, cidr, description=''):
         self.id = str(uuid.uuid4())
         self.cidr = cidr
+        self.net_start, self.net_end = cidr_range(cidr)
 
     def to_ip(self):
         if IPNetwork(self.cidr).version == 4:
@@ -479,10 +537,7 @@ class Anycast(Base):
             return IPv6Network(self.cidr)
 
     def contains(self, ip):
-        if IPAddress(ip).version == 4:
-            return self.to_ip().Contains(IPv4Address(ip))
-        else:
-            return self.to_ip().Contains(IPv6Address(ip))
+        return self.net_start <= address_key(ip) <= self.net_end
 
     def __repr__(self):
        return "<Anycast('%s','%s')>" % (self.id, self.cidr)
@@ -500,13 +555,15 @@ class Anycastip(Base):
 
     id = Column(String(36), primary_key=True)
     ip = Column(String(255), unique=True)
+    address = Column(String(33), index=True)
     description = Column(String(255))
-    anycast_id = Column(String(36), ForeignKey('anycasts.id'))
+    anycast_id = Column(String(36), ForeignKey('anycasts.id'), index=True)
     anycast = relationship('Anycast')
 
     def __init__(self, ip, anycast_id, description=''):
         self.id = str(uuid.uuid4())
         self.ip = ip
+        self.address = address_key(ip)
         self.anycast_id = anycast_id
 
     def __repr__(self):
@@ -539,7 +596,8 @@ class Policy(Base):
     status = Column(String(50), server_default="")
     owner_id = Column(String(46), index=True)
 
-    __table_args__  = (UniqueConstraint("proto", "src", "src_port", "dst", "dst_port", "table", "policy", "in_iface", "out_iface", "owner_type", "owner_id"),)
+    __table_args__  = (UniqueConstraint("proto", "src", "src_port", "dst", "dst_port", "table", "policy", "in_iface", "out_iface", "owner_type", "owner_id"),
+                       Index("ix_policies_owner_type_owner_id", "owner_type", "owner_id"))
     __mapper_args__ = {'polymorphic_on': owner_type}
 
     def __init__(self, **kwargs):
@@ -739,8 +797,12 @@ else:
                             database_pass,
                             database_host,
                             database_name),
-                            pool_size=10,
-                            max_overflow=4,
-                            pool_recycle=120)
+                            poolclass=TimedQueuePool,
+                            pool_size=get_option('server', 'database_pool_size', 10),
+                            max_overflow=get_option('server', 'database_max_overflow', 4),
+                            pool_timeout=get_option('server', 'database_pool_timeout', 30),
+                            pool_recycle=get_option('server', 'database_pool_recycle', 120))
+    if get_option('server', 'database_pool_pre_ping', False):
+        event.listen(engine, 'checkout', ping_on_checkout)
 
 Base.metadata.create_all(engine)
@@ -0,0 +1,94 @@
+# Copyright 2012 Locaweb.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+# @author: Juliano Martinez (ncode), Locaweb.
+# @author: Luiz Ozaki, Locaweb.
+
+"""Connection pool instrumentation for the database engine"""
+
+import threading
+import time
+
+from sqlalchemy import exc
+from sqlalchemy.pool import QueuePool
+
+_lock = threading.Lock()
+_counters = {
+    'checkouts': 0,
+    'timeouts': 0,
+    'disconnects': 0,
+    'wait_total': 0.0,
+    'wait_max': 0.0,
+    'wait_last': 0.0,
+}
+
+
+def _record_wait_(wait):
+    with _lock:
+        _counters['checkouts'] += 1
+        _counters['wait_total'] += wait
+        _counters['wait_last'] = wait
+        if wait > _counters['wait_max']:
+            _counters['wait_max'] = wait
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool keeping how long checkouts wait for a connection. The
+    counters are kept by module, as the engine recreates its pool after a
+    disconnection."""
+
+    def _timed_(self, checkout):
+        start = time.time()
+        try:
+            return checkout()
+        except exc.TimeoutError:
+            with _lock:
+                _counters['timeouts'] += 1
+            raise
+        finally:
+            _record_wait_(time.time() - start)
+
+    def connect(self):
+        return self._timed_(super(TimedQueuePool, self).connect)
+
+    def unique_connection(self):
+        return self._timed_(super(TimedQueuePool, self).unique_connection)
+
+
+def ping_on_checkout(dbapi_con, con_record, con_proxy):
+    """Checkout listener testing the connection before handing it out, so
+    connections dropped by the server are replaced instead of failing the
+    request using them"""
+    try:
+        cursor = dbapi_con.cursor()
+        cursor.execute("SELECT 1")
+        cursor.close()
+    except Exception:
+        with _lock:
+            _counters['disconnects'] += 1
+        raise exc.DisconnectionError()
+
+
+def pool_stats(engine):
+    with _lock:
+        stats = dict(_counters)
+    checkouts = stats['checkouts']
+    stats['wait_avg'] = stats['wait_total'] / checkouts if checkouts else 0.0
+    pool = engine.pool
+    if isinstance(pool, QueuePool):
+        stats['size'] = pool.size()
+        stats['checkedout'] = pool.checkedout()
+        stats['overflow'] = pool.overflow()
+    return stats
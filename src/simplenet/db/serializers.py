@@ -0,0 +1,345 @@
+# Copyright 2012 Locaweb.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+# @author: Juliano Martinez (ncode), Locaweb.
+# @author: Luiz Ozaki, Locaweb.
+
+"""Projections build the same dicts as the models to_dict, key by key,
+straight from column queries and explicit joins. No ORM object is loaded,
+so listing entries costs one query plus one per chunk of nested lists
+instead of a lazy load per relationship and entry."""
+
+from simplenet.db.models import (
+    cidr_gateway, cidr_network, Datacenter, Zone, Dhcp, Firewall, Router,
+    Switch, Interface, Vlan, Subnet, Ip, Anycast, Anycastip, Policy
+)
+
+CHUNK_SIZE = 500
+
+
+class Projection(object):
+    """model: the model the entries come from
+    columns: the columns read, joined ones labelled with their key
+    joins: (target, onclause) outer joins needed by the columns"""
+
+    model = None
+    columns = ()
+    joins = ()
+
+    def query(self, session):
+        ss = session.query(*self.columns).select_from(self.model)
+        for target, onclause in self.joins:
+            ss = ss.outerjoin(target, onclause)
+        return ss
+
+    def to_dict(self, row):
+        raise NotImplementedError
+
+    def children(self, session, values):
+        """Fills the nested lists of a chunk of dicts"""
+        pass
+
+    def serialize(self, session, rows, chunk_size=CHUNK_SIZE):
+        chunk = []
+        for row in rows:
+            chunk.append(self.to_dict(row))
+            if len(chunk) == chunk_size:
+                self.children(session, chunk)
+                for value in chunk:
+                    yield value
+                chunk = []
+        if chunk:
+            self.children(session, chunk)
+            for value in chunk:
+                yield value
+
+
+class DatacenterProjection(Projection):
+
+    model = Datacenter
+    columns = (Datacenter.id, Datacenter.name)
+
+    def to_dict(self, row):
+        return { 'id': row.id, 'name': row.name }
+
+
+class ZoneProjection(Projection):
+
+    model = Zone
+    columns = (Zone.id, Zone.name, Datacenter.name.label('datacenter'),
+               Zone.datacenter_id)
+    joins = ((Datacenter, Zone.datacenter_id == Datacenter.id),)
+
+    def to_dict(self, row):
+        return {
+            'id': row.id,
+            'name': row.name,
+            'datacenter': row.datacenter,
+            'datacenter_id': row.datacenter_id,
+        }
+
+
+class DhcpProjection(Projection):
+
+    model = Dhcp
+    columns = (Dhcp.id, Dhcp.name)
+
+    def to_dict(self, row):
+        return {
+            'id': row.id,
+            'name': row.name,
+        }
+
+
+class FirewallProjection(Projection):
+
+    model = Firewall
+    columns = (Firewall.id, Firewall.name, Zone.name.label('zone'),
+               Firewall.zone_id, Firewall.mac, Firewall.address,
+               Firewall.status)
+    joins = ((Zone, Firewall.zone_id == Zone.id),)
+
+    def to_dict(self, row):
+        return {
+            'id': row.id,
+            'name': row.name,
+            'zone': row.zone,
+            'zone_id': row.zone_id,
+            'mac': row.mac,
+            'address': row.address,
+            'status': row.status,
+        }
+
+
+class RouterProjection(FirewallProjection):
+
+    model = Router
+    columns = (Router.id, Router.name, Zone.name.label('zone'),
+               Router.zone_id, Router.mac, Router.address, Router.status)
+    joins = ((Zone, Router.zone_id == Zone.id),)
+
+
+class SwitchProjection(Projection):
+
+    model = Switch
+    columns = (Switch.id, Switch.name, Switch.model_type, Switch.mac,
+               Switch.address)
+
+    def to_dict(self, row):
+        return {
+            'id': row.id,
+            'name': row.name,
+            'model_type': row.model_type,
+            'mac': row.mac,
+            'address': row.address,
+        }
+
+
+class InterfaceProjection(Projection):
+
+    model = Interface
+    columns = (Interface.id, Interface.name, Interface.hostname,
+               Vlan.id.label('vlan_id'), Switch.id.label('switch_id'))
+    joins = ((Vlan, Interface.vlan_id == Vlan.id),
+             (Switch, Interface.switch_id == Switch.id))
+
+    def to_dict(self, row):
+        return {
+            'id': row.id,
+            'name': row.name,
+            'hostname': row.hostname,
+            'vlan_id': row.vlan_id,
+            'switch_id': row.switch_id,
+            'ips': [],
+        }
+
+    def children(self, session, values):
+        by_id = dict((value['id'], value) for value in values)
+        ss = session.query(Ip.interface_id, Ip.ip).filter(
+            Ip.interface_id.in_(by_id.keys())
+        )
+        for interface_id, ip in ss:
+            by_id[interface_id]['ips'].append(ip)
+
+
+class VlanProjection(Projection):
+
+    model = Vlan
+    columns = (Vlan.id, Vlan.name, Vlan.type, Vlan.vlan_num,
+               Zone.name.label('zone'), Vlan.zone_id)
+    joins = ((Zone, Vlan.zone_id == Zone.id),)
+
+    def to_dict(self, row):
+        return {
+            'id': row.id,
+            'name': row.name,
+            'type': row.type,
+            'vlan_num': row.vlan_num,
+            'zone': row.zone,
+            'zone_id': row.zone_id,
+        }
+
+
+class IpProjection(Projection):
+
+    model = Ip
+    columns = (Ip.id, Ip.ip, Subnet.cidr.label('subnet'), Ip.subnet_id,
+               Ip.interface_id, Interface.hostname.label('hostname'))
+    joins = ((Subnet, Ip.subnet_id == Subnet.id),
+             (Interface, Ip.interface_id == Interface.id))
+
+    def to_dict(self, row):
+        return {
+            'id': row.id,
+            'ip': row.ip,
+            'subnet': row.subnet,
+            'subnet_id': row.subnet_id,
+            'interface_id': row.interface_id,
+            'hostname': row.hostname,
+        }
+
+
+class SubnetProjection(Projection):
+
+    model = Subnet
+    columns = (Subnet.id, Subnet.cidr, Vlan.name.label('vlan'),
+               Subnet.vlan_id)
+    joins = ((Vlan, Subnet.vlan_id == Vlan.id),)
+
+    def to_dict(self, row):
+        return {
+            'id': row.id,
+            'cidr': row.cidr,
+            'vlan': row.vlan,
+            'vlan_id': row.vlan_id,
+            'gateway': cidr_gateway(row.cidr),
+            'network': cidr_network(row.cidr),
+            'ips': [],
+        }
+
+    def children(self, session, values):
+        by_id = dict((value['id'], value) for value in values)
+        ips = IpProjection()
+        ss = ips.query(session).filter(Ip.subnet_id.in_(by_id.keys()))
+        for row in ss:
+            by_id[row.subnet_id]['ips'].append(ips.to_dict(row))
+
+
+class AnycastProjection(Projection):
+
+    model = Anycast
+    columns = (Anycast.id, Anycast.cidr)
+
+    def to_dict(self, row):
+        return {
+            'id': row.id,
+            'cidr': row.cidr,
+        }
+
+
+class AnycastipProjection(Projection):
+
+    model = Anycastip
+    columns = (Anycastip.id, Anycastip.ip, Anycast.cidr.label('anycast'),
+               Anycastip.anycast_id)
+    joins = ((Anycast, Anycastip.anycast_id == Anycast.id),)
+
+    def to_dict(self, row):
+        return {
+            'id': row.id,
+            'ip': row.ip,
+            'anycast': row.anycast,
+            'anycast_id': row.anycast_id,
+        }
+
+
+class PolicyProjection(Projection):
+    """owner_type: the policies listed
+    owner: the column naming the owner of the policy"""
+
+    model = Policy
+    owner_type = None
+    owner = None
+
+    def __init__(self, owner_type, owner):
+        self.owner_type = owner_type
+        self.owner = owner
+        self.columns = (
+            Policy.id, Policy.owner_id, Policy.proto, Policy.src,
+            Policy.src_port, Policy.dst, Policy.dst_port, Policy.table,
+            Policy.policy, Policy.status, Policy.in_iface, Policy.out_iface,
+            owner.label('owner'),
+        )
+        self.joins = ((owner.class_, Policy.owner_id == owner.class_.id),)
+
+    def query(self, session):
+        ss = super(PolicyProjection, self).query(session)
+        return ss.filter(Policy.owner_type == self.owner_type)
+
+    def to_dict(self, row):
+        if self.owner_type == 'ip':
+            return { 'id': row.id,
+                     'owner_id': row.owner_id,
+                     'proto': row.proto,
+                     'src': row.src,
+                     'src_port': row.src_port,
+                     'dst': row.dst,
+                     'dst_port': row.dst_port,
+                     'table': row.table,
+                     'policy': row.policy,
+                     'status': row.status,
+                     'in_iface': row.in_iface,
+                     'out_iface': row.out_iface,
+                     'owner': row.owner }
+        return { 'id': row.id,
+                 'owner_id': row.owner_id,
+                 'proto': row.proto,
+                 'src': row.src,
+                 'src_port': row.src_port,
+                 'dst': row.dst,
+                 'dst_port': row.dst_port,
+                 'table': row.table,
+                 'policy': row.policy,
+                 'status': row.status,
+                 'owner': row.owner }
+
+
+projections = {
+    'Datacenter': DatacenterProjection(),
+    'Zone': ZoneProjection(),
+    'Dhcp': DhcpProjection(),
+    'Firewall': FirewallProjection(),
+    'Router': RouterProjection(),
+    'Switch': SwitchProjection(),
+    'Interface': InterfaceProjection(),
+    'Vlan': VlanProjection(),
+    'Subnet': SubnetProjection(),
+    'Ip': IpProjection(),
+    'Anycast': AnycastProjection(),
+    'Anycastip': AnycastipProjection(),
+    'DatacenterPolicy': PolicyProjection('datacenter', Datacenter.name),
+    'ZonePolicy': PolicyProjection('zone', Zone.name),
+    'VlanPolicy': PolicyProjection('vlan', Vlan.name),
+    'AnycastPolicy': PolicyProjection('anycast', Anycast.cidr),
+    'SubnetPolicy': PolicyProjection('subnet', Subnet.cidr),
+    'AnycastipPolicy': PolicyProjection('anycastip', Anycastip.ip),
+    'IpPolicy': PolicyProjection('ip', Ip.ip),
+}
+
+
+def get_projection(model_name):
+    """The projection for model_name, None when its entries have to go
+    through to_dict"""
+    return projections.get(model_name)
@@ -68,3 +68,11 @@ class DuplicatedEntryError(SimpleNetError):
         simplenet_error.__init__(
             403, "%s:%s Duplicated" % (forbidden_type, forbidden_id)
         )
+
+
+class InvalidQueryParameter(SimpleNetError):
+    def __init__(self, parameter):
+        simplenet_error = super(InvalidQueryParameter, self)
+        simplenet_error.__init__(
+            400, "%s: invalid query parameter" % parameter
+        )
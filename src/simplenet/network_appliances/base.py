@@ -16,28 +16,82 @@
 # @author: Juliano Martinez (ncode), Locaweb.
 # @author: Luiz Ozaki, Locaweb.
 
+import uuid
+
 from uuid import UUID
-from simplenet.common.config import get_logger
+from simplenet.common.cache import LRUCache
+from simplenet.common.config import get_logger, get_option
 from simplenet.common.hooks import post_run
 from simplenet.db.models import (
         new_model, Prober, Datacenter, Zone, Interface,
-        Vlan, Subnet, Anycast, Ip, Anycastip
+        Vlan, Subnet, Anycast, Ip, Anycastip, IpPolicy, address_key,
+        cidr_range, key_address, cidr_gateway, cidr_network
 )
 from simplenet.common import event
-from simplenet.db import db_utils
+from simplenet.db import allocator, db_utils
+from simplenet.db.serializers import get_projection
 from simplenet.exceptions import (
     FeatureNotAvailable, EntityNotFound,
     OperationNotPermited, DuplicatedEntryError,
-    OperationFailed
+    OperationFailed, InvalidQueryParameter, SimpleNetError
 )
+from sqlalchemy import func
 from sqlalchemy.exc import IntegrityError
 
+# Levels of the ip -> datacenter hierarchy: name, model, name column and
+# the column pointing to the next level
+ANCESTRY = (
+    ('ip', Ip, Ip.ip, Ip.subnet_id),
+    ('subnet', Subnet, Subnet.cidr, Subnet.vlan_id),
+    ('vlan', Vlan, Vlan.name, Vlan.zone_id),
+    ('zone', Zone, Zone.name, Zone.datacenter_id),
+    ('datacenter', Datacenter, Datacenter.name, None),
+)
+ANCESTRY_CACHE_SIZE = 100000
+ANCESTRY_CACHE_TTL = get_option("server", "ancestry_cache_ttl", 30)
+
+# Rows fetched at a time when streaming a list
+LIST_CHUNK_SIZE = 500
+
+# Most addresses handed out by a single allocation
+ALLOCATE_LIMIT = get_option("server", "allocate_limit", 10000)
+
+
+
+def _chunks_(values, size=LIST_CHUNK_SIZE):
+    """Splits values in lists of up to size, to keep IN clauses short"""
+    values = list(values)
+    for i in xrange(0, len(values), size):
+        yield values[i:i + size]
+
+
+def _invalid_(entity, item):
+    return OperationNotPermited(entity, "%s is not a valid input" % (item,)).output
+
+# Ancestry by entity id. Entities can't be moved or renamed, so entries go
+# away when the entity or one of its ancestors is deleted, or after
+# ANCESTRY_CACHE_TTL, for the deletes made by other processes
+_ancestry_cache = LRUCache(ANCESTRY_CACHE_SIZE, ANCESTRY_CACHE_TTL)
+
+
+def _forget_ancestry_(ids, descendants=True):
+    """Drops the cached ancestry of the given entities and, unless they
+    can't have any, of every entity below them"""
+    ids = set(ids)
+    if not descendants:
+        for id in ids:
+            _ancestry_cache.delete(id)
+        return
+    _ancestry_cache.purge(lambda key, ancestry: key in ids or any(
+        ancestry.get('%s_id' % level) in ids for level, _, _, _ in ANCESTRY
+    ))
+
 
 class SimpleNet(object):
 
     def __init__(self):
         self.logger = get_logger()
-        self.session = db_utils.get_database_session()
+        self.session = db_utils.get_scoped_session()
 
     @staticmethod
     def retrieve_valid_uuid(data, _func, field):
@@ -52,16 +106,45 @@ class SimpleNet(object):
 
         return data
 
-    def _generic_list_(self, model_name):
+    def _generic_query_(self, model_name):
+        """Returns the model, a query for its entries and the function
+        turning the query rows into dicts. Models with a projection are read
+        column by column, the others go through to_dict."""
         model, name = new_model(model_name)
-        self.logger.debug("Listing %s" % name)
-        ss = self.session.query(model).all()
-        _values = []
-        for _value in ss:
-            _values.append(
-                _value.to_dict(),
+        projection = get_projection(model_name)
+        if projection:
+            serialize = lambda rows: projection.serialize(
+                self.session, rows, LIST_CHUNK_SIZE
             )
-        self.logger.debug("Received %s: %s" % (name, _values))
+            return model, projection.query(self.session), serialize
+        serialize = lambda rows: (_value.to_dict() for _value in rows)
+        return model, self.session.query(model), serialize
+
+    @staticmethod
+    def _criteria_(model, value):
+        return [getattr(model, key) == val for key, val in value.iteritems()]
+
+    def _generic_list_(self, model_name, limit=None, after=None,
+                       filters=None, stream=False):
+        """Lists entries of model_name. filters are matched against the
+        model columns in SQL, limit and after page through the entries by
+        id and stream returns a generator reading them in chunks."""
+        model, ss, serialize = self._generic_query_(model_name)
+        self.logger.debug("Listing %s" % model.__tablename__)
+        for column, value in (filters or {}).iteritems():
+            if column not in model.__table__.c:
+                raise InvalidQueryParameter(column)
+            ss = ss.filter(model.__table__.c[column] == value)
+        if limit or after or stream:
+            ss = ss.order_by(model.id)
+        if after:
+            ss = ss.filter(model.id > after)
+        if limit:
+            ss = ss.limit(limit)
+        if stream:
+            return serialize(ss.yield_per(LIST_CHUNK_SIZE))
+        _values = list(serialize(ss))
+        self.logger.debug("Received %s: %s" % (model.__tablename__, _values))
         return _values
 
     def _generic_delete_(self, model_name, value):
@@ -77,53 +160,63 @@ class SimpleNet(object):
         except Exception, e:
             self.session.rollback()
             raise Exception(e)
+        _forget_ancestry_([getattr(ss, 'id', None)], descendants=model is not Ip)
         self.logger.debug("Successful deletion of %s from %s" % (value, name))
         return True
 
     def _generic_info_(self, model_name, value):
-        model, name = new_model(model_name)
+        model, ss, serialize = self._generic_query_(model_name)
+        name = model.__tablename__
         self.logger.debug("Getting %s info by %s" % (name, value))
-        ss = self.session.query(model).filter_by(**value).first()
-        if not ss:
+        ss = ss.filter(*self._criteria_(model, value)).limit(1)
+        data = next(serialize(ss), None)
+        if not data:
             raise EntityNotFound(name, value)
-        data = ss.to_dict()
         self.logger.debug("Received %s from [%s]" % (data, value))
         return data
 
     def _generic_list_by_something_(self, model_name, value):
-        model, name = new_model(model_name)
+        model, ss, serialize = self._generic_query_(model_name)
+        name = model.__tablename__
         self.logger.debug("Getting %s by %s" % (name, value))
-        ss = self.session.query(model).filter_by(**value).all()
-        _values = []
-        for _value in ss:
-            _values.append(
-                _value.to_dict()
-            )
+        ss = ss.filter(*self._criteria_(model, value))
+        _values = list(serialize(ss))
         self.logger.debug("Received %s: %s from [%s]" % (name, _values, value))
         return _values
 
+    def _get_ancestry_(self, level, id):
+        """Returns the names and ids of the entity and every level above
+        it, up to its datacenter, resolved through a single joined query
+        and cached by id."""
+        cached = _ancestry_cache.get(id)
+        if cached is not None:
+            return dict(cached)
+
+        levels = [entry[0] for entry in ANCESTRY]
+        chain = ANCESTRY[levels.index(level):]
+        columns = []
+        for _, model, name_column, _ in chain:
+            columns.extend([model.id, name_column])
+        query = self.session.query(*columns)
+        for (_, _, _, parent), (_, model, _, _) in zip(chain, chain[1:]):
+            query = query.join(model, parent == model.id)
+        row = query.filter(chain[0][1].id == id).first()
+        if row is None:
+            raise EntityNotFound(chain[0][1].__tablename__, {'id': id})
+
+        ancestry = {}
+        for i, (name, _, _, _) in enumerate(chain):
+            ancestry['%s_id' % name] = row[i * 2]
+            ancestry[name] = row[i * 2 + 1]
+        _ancestry_cache.set(id, ancestry)
+        self.logger.debug("Received %s ancestry: %s from [%s]" % (level, ancestry, id))
+        return dict(ancestry)
+
     def _get_data_ip_(self, id):
         self.logger.debug("Getting ip data %s" % id)
-        ip = self.ip_info(id)
-        subnet = self.subnet_info(ip['subnet_id'])
-        vlan = self.vlan_info(subnet['vlan_id'])
-        zone = self.zone_info(vlan['zone_id'])
-        datacenter = self.datacenter_info(zone['datacenter_id'])
-        self.logger.debug("Received ip: %s vlan: %s zone: %s "
-            "datacenter: %s from [%s]" %
-            (ip, vlan, zone, datacenter, id)
-        )
-        return {
-            'ip': ip['ip'],
-            'subnet': subnet['cidr'],
-            'subnet_id': subnet['id'],
-            'vlan': vlan['name'],
-            'vlan_id': vlan['id'],
-            'zone': zone['name'],
-            'zone_id': zone['id'],
-            'datacenter': datacenter['name'],
-            'datacenter_id': datacenter['id'],
-        }
+        data = self._get_ancestry_('ip', id)
+        del data['ip_id']
+        return data
 
     def _get_data_anycastip_(self, id):
         self.logger.debug("Getting ip anycast data %s" % id)
@@ -140,24 +233,10 @@ class SimpleNet(object):
 
     def _get_data_subnet_(self, id):
         self.logger.debug("Getting subnet data %s" % id)
-        subnet = self.subnet_info(id)
-        vlan = self.vlan_info(subnet['vlan_id'])
-        zone = self.zone_info(vlan['zone_id'])
-        datacenter = self.datacenter_info(zone['datacenter_id'])
-        self.logger.debug("Received subnet: %s vlan: %s "
-            "zone: %s datacenter: %s from [%s]" %
-            (subnet, vlan, zone, datacenter, id)
-        )
-        return {
-            'subnet': subnet['cidr'],
-            'vlan': vlan['name'],
-            'vlan_id': vlan['id'],
-            'zone': zone['name'],
-            'zone_id': zone['id'],
-            'datacenter': datacenter['name'],
-            'datacenter_id': datacenter['id'],
-            'ips': self.ip_list_by_subnet(id)
-        }
+        data = self._get_ancestry_('subnet', id)
+        del data['subnet_id']
+        data['ips'] = self.ip_list_by_subnet(id)
+        return data
 
     def _get_data_anycast_(self, id):
         self.logger.debug("Getting anycast data %s" % id)
@@ -173,37 +252,16 @@ class SimpleNet(object):
 
     def _get_data_vlan_(self, id):
         self.logger.debug("Getting vlan data %s" % id)
-        vlan = self.vlan_info(id)
-        zone = self.zone_info(vlan['zone_id'])
-        datacenter = self.datacenter_info(zone['datacenter_id'])
-        self.logger.debug("Received vlan: %s zone: %s "
-            "datacenter: %s from [%s]" % (vlan, zone, datacenter, id)
-        )
-        return {
-            'vlan': vlan['name'],
-            'vlan_id': vlan['id'],
-            'zone': zone['name'],
-            'zone_id': zone['id'],
-            'datacenter': datacenter['name'],
-            'datacenter_id': datacenter['id'],
-            'subnets': self.subnet_list_by_vlan(id),
-        }
+        data = self._get_ancestry_('vlan', id)
+        data['subnets'] = self.subnet_list_by_vlan(id)
+        return data
 
     def _get_data_zone_(self, id):
         self.logger.debug("Getting zone data %s" % id)
-        zone = self.zone_info(id)
-        datacenter = self.datacenter_info(zone['datacenter_id'])
-        self.logger.debug("Received zone: %s datacenter: %s from [%s]" %
-            (zone, datacenter, id)
-        )
-        return {
-            'zone': zone['name'],
-            'zone_id': zone['id'],
-            'datacenter': datacenter['name'],
-            'datacenter_id': datacenter['id'],
-            'vlans': [ self._get_data_vlan_(vlan['id'])
-                       for vlan in self.vlan_list_by_zone(id) ]
-        }
+        data = self._get_ancestry_('zone', id)
+        data['vlans'] = [ self._get_data_vlan_(vlan['id'])
+                          for vlan in self.vlan_list_by_zone(id) ]
+        return data
 
     def _get_data_datacenter_(self, id):
         self.logger.debug("Getting datacenter data %s" % id)
@@ -232,8 +290,8 @@ class SimpleNet(object):
             "Router", {'zone_id': zone_id}
         )
 
-    def datacenter_list(self):
-        return self._generic_list_("Datacenter")
+    def datacenter_list(self, **kwargs):
+        return self._generic_list_("Datacenter", **kwargs)
 
     def datacenter_create(self, data):
         self.logger.debug("Creating datacenter using data: %s" % data)
@@ -268,8 +326,8 @@ class SimpleNet(object):
     def datacenter_delete(self, id):
         return self._generic_delete_("Datacenter", {'id': id})
 
-    def zone_list(self):
-        return self._generic_list_("Zone")
+    def zone_list(self, **kwargs):
+        return self._generic_list_("Zone", **kwargs)
 
     def zone_list_by_datacenter(self, datacenter_id):
         return self._generic_list_by_something_(
@@ -319,8 +377,8 @@ class SimpleNet(object):
     def zone_delete(self, id):
         return self._generic_delete_("Zone", {'id': id})
 
-    def vlan_list(self):
-        return self._generic_list_("Vlan")
+    def vlan_list(self, **kwargs):
+        return self._generic_list_("Vlan", **kwargs)
 
     def vlan_list_by_firewall(self, firewall_id):
         return self._generic_list_by_something_(
@@ -380,11 +438,11 @@ class SimpleNet(object):
     def vlan_delete(self, id):
         return self._generic_delete_("Vlan", {'id': id})
 
-    def subnet_list(self):
-        return self._generic_list_("Subnet")
+    def subnet_list(self, **kwargs):
+        return self._generic_list_("Subnet", **kwargs)
 
-    def anycast_list(self):
-        return self._generic_list_("Anycast")
+    def anycast_list(self, **kwargs):
+        return self._generic_list_("Anycast", **kwargs)
 
     def anycast_list_by_firewall(self, firewall_id):
         return self._generic_list_by_something_(
@@ -457,6 +515,26 @@ class SimpleNet(object):
             "Subnet", {'cidr': cidr.replace('_','/')}
         )
 
+    def _info_by_address_(self, model_name, ip):
+        """The most specific entry of model_name whose range holds ip,
+        through one range lookup on its (net_start, net_end) index"""
+        model, ss, serialize = self._generic_query_(model_name)
+        try:
+            key = address_key(ip)
+        except ValueError:
+            raise InvalidQueryParameter(ip)
+        ss = ss.filter(model.net_start <= key).filter(model.net_end >= key)
+        data = next(serialize(ss.order_by(model.net_start.desc()).limit(1)), None)
+        if not data:
+            raise EntityNotFound(model.__tablename__, {'ip': ip})
+        return data
+
+    def subnet_info_by_ip(self, ip):
+        return self._info_by_address_("Subnet", ip)
+
+    def anycast_info_by_ip(self, ip):
+        return self._info_by_address_("Anycast", ip)
+
     def subnet_update(self, *args, **kwargs):
         raise FeatureNotAvailable()
 
@@ -468,17 +546,132 @@ class SimpleNet(object):
         #self._enqueue_dhcp_entries_(vlan, 'update')
         return ret
 
+    def subnet_create_many(self, items):
+        """Creates the subnets described by items, dicts like the ones taken
+        by subnet_create, in one transaction. Returns, in the same order,
+        each created subnet or the error that kept it from being created."""
+        self.logger.debug("Creating %s subnets" % len(items))
+        results = [None] * len(items)
+        ranges = {}
+        for i, item in enumerate(items):
+            try:
+                if not isinstance(item['vlan_id'], basestring):
+                    results[i] = _invalid_('Subnet', item)
+                    continue
+                ranges[i] = cidr_range(item['cidr'])
+            except (TypeError, KeyError, ValueError):
+                results[i] = _invalid_('Subnet', item)
+
+        self.session.begin(subtransactions=True)
+        try:
+            vlans = {}
+            for chunk in _chunks_(set(items[i]['vlan_id'] for i in ranges)):
+                ss = self.session.query(Vlan.id, Vlan.name).filter(Vlan.id.in_(chunk))
+                vlans.update((x.id, x.name) for x in ss)
+            taken = set()
+            for chunk in _chunks_(set(items[i]['cidr'] for i in ranges)):
+                ss = self.session.query(Subnet.cidr).filter(Subnet.cidr.in_(chunk))
+                taken.update(x.cidr for x in ss)
+
+            rows = []
+            for i in sorted(ranges):
+                cidr, vlan_id = items[i]['cidr'], items[i]['vlan_id']
+                if vlan_id not in vlans:
+                    results[i] = OperationNotPermited(
+                        'Subnet', "vlan_id %s doesnt exist" % vlan_id
+                    ).output
+                elif cidr in taken:
+                    results[i] = DuplicatedEntryError(
+                        'Subnet', "%s already exists" % cidr
+                    ).output
+                else:
+                    taken.add(cidr)
+                    row = {
+                        'id': str(uuid.uuid4()),
+                        'cidr': cidr,
+                        'net_start': ranges[i][0],
+                        'net_end': ranges[i][1],
+                        'allocation_version': 0,
+                        'vlan_id': vlan_id,
+                    }
+                    rows.append(row)
+                    results[i] = {
+                        'id': row['id'],
+                        'cidr': cidr,
+                        'vlan': vlans[vlan_id],
+                        'vlan_id': vlan_id,
+                        'gateway': cidr_gateway(cidr),
+                        'network': cidr_network(cidr),
+                        'ips': [],
+                    }
+            if rows:
+                self.session.execute(Subnet.__table__.insert(), rows)
+            self.session.commit()
+        except:
+            self.session.rollback()
+            raise
+        self.logger.debug("Created %s of %s subnets" % (len(rows), len(items)))
+        return results
+
+    def subnet_delete_many(self, ids):
+        """Deletes the subnets with the given ids in one transaction,
+        returning True or the error of each one, in the same order. Their
+        ips are kept, unlinked from the subnet, like subnet_delete does."""
+        results = [None] * len(ids)
+        self.session.begin(subtransactions=True)
+        try:
+            found = set()
+            for chunk in _chunks_(set(ids)):
+                ss = self.session.query(Subnet.id).filter(Subnet.id.in_(chunk))
+                found.update(x.id for x in ss.with_lockmode('update'))
+            for i, id in enumerate(ids):
+                if id in found:
+                    results[i] = True
+                else:
+                    results[i] = EntityNotFound('Subnet', id).output
+            for chunk in _chunks_(found):
+                self.session.query(Ip).filter(Ip.subnet_id.in_(chunk)).update(
+                    {'subnet_id': None}, synchronize_session=False
+                )
+                self.session.query(Subnet).filter(
+                    Subnet.id.in_(chunk)
+                ).delete(synchronize_session=False)
+            self.session.commit()
+        except:
+            self.session.rollback()
+            raise
+        _forget_ancestry_(found)
+        self.logger.debug("Deleted %s subnets" % len(found))
+        return results
+
     def anycast_delete(self, id):
         return self._generic_delete_("Anycast", {'id': id})
 
-    def ip_list(self):
-        return self._generic_list_("Ip")
+    def ip_list(self, **kwargs):
+        return self._generic_list_("Ip", **kwargs)
 
     def ip_list_by_subnet(self, subnet_id):
         return self._generic_list_by_something_(
             "Ip", {'subnet_id': subnet_id}
         )
 
+    def _list_by_cidr_(self, model_name, cidr):
+        """Entries of model_name with an address within cidr, in address
+        order"""
+        model, ss, serialize = self._generic_query_(model_name)
+        try:
+            start, end = cidr_range(cidr.replace('_', '/'))
+        except ValueError:
+            raise InvalidQueryParameter(cidr)
+        ss = ss.filter(model.address.between(start, end))
+        return list(serialize(ss.order_by(model.address)))
+
+    def ip_list_by_cidr(self, cidr):
+        return self._list_by_cidr_("Ip", cidr)
+
+    def anycastip_list_by_cidr(self, cidr):
+        return self._list_by_cidr_("Anycastip", cidr)
+
     def ip_list_by_id(self, ip_id):
         return self._generic_list_by_something_(
             "Ip", {'id': ip_id}
@@ -489,8 +682,8 @@ class SimpleNet(object):
             "Anycastip", {'anycast_id': anycast_id}
         )
 
-    def anycastip_list(self):
-        return self._generic_list_("Anycastip")
+    def anycastip_list(self, **kwargs):
+        return self._generic_list_("Anycastip", **kwargs)
 
     def ip_create(self, subnet_id, data):
         self.logger.debug("Creating ip on subnet: %s using data: %s" %
@@ -508,6 +701,7 @@ class SimpleNet(object):
             )
         self.session.begin(subtransactions=True)
         try:
+            self._touch_subnet_(subnet_id)
             self.session.add(Ip(ip=data['ip'], subnet_id=subnet_id))
             self.session.commit()
         except IntegrityError, e:
@@ -528,6 +722,154 @@ class SimpleNet(object):
         )
         return self.ip_info_by_ip(data['ip'])
 
+    def _touch_subnet_(self, subnet_id):
+        """Bumps the allocation version of the subnet, locking its row, so
+        allocations see its ips changed"""
+        self.session.query(Subnet).filter_by(id=subnet_id).update(
+            {'allocation_version': func.coalesce(Subnet.allocation_version, 0) + 1},
+            synchronize_session=False
+        )
+
+    def ip_allocate(self, subnet_id, count=1):
+        """Creates ips for the count lowest free addresses of the subnet in
+        one transaction. The subnet row stays locked meanwhile, so
+        concurrent allocations never pick the same addresses."""
+        self.logger.debug("Allocating %s ips on subnet: %s" % (count, subnet_id))
+        if not 0 < count <= ALLOCATE_LIMIT:
+            raise OperationNotPermited(
+                'Ip', "count must be between 1 and %s" % ALLOCATE_LIMIT
+            )
+        self.session.begin(subtransactions=True)
+        try:
+            subnet = self.session.query(Subnet).with_lockmode('update').get(subnet_id)
+            if subnet is None:
+                raise EntityNotFound('Subnet', subnet_id)
+            cidr = subnet.cidr
+            version = subnet.allocation_version or 0
+            ranges = allocator.cached(subnet_id, version)
+            if ranges is None:
+                # By address, as ips of deleted or overlapping subnets still
+                # hold theirs
+                used = self.session.query(Ip.address).filter(
+                    Ip.address.between(subnet.net_start, subnet.net_end)
+                )
+                ranges = allocator.FreeRanges(subnet.cidr, [x.address for x in used])
+            if ranges.size < count:
+                raise OperationNotPermited(
+                    'Subnet', "%s has %s free addresses" % (subnet.cidr, ranges.size)
+                )
+            ips = []
+            for key in ranges.take(count):
+                ips.append({
+                    'id': str(uuid.uuid4()),
+                    'ip': key_address(key),
+                    'address': key,
+                    'subnet_id': subnet_id,
+                })
+            self.session.execute(Ip.__table__.insert(), ips)
+            subnet.allocation_version = version + 1
+            self.session.commit()
+        except IntegrityError, e:
+            self.session.rollback()
+            allocator.discard(subnet_id)
+            msg = str(e)
+            if msg.find("is not unique") != -1 or msg.find("Duplicate entry") != -1 or msg.find("UNIQUE constraint failed") != -1:
+                raise DuplicatedEntryError(
+                    'Ip', "an address allocated on %s already exists" % cidr
+                )
+            raise OperationNotPermited('Ip', "Unknown error")
+        except:
+            self.session.rollback()
+            allocator.discard(subnet_id)
+            raise
+        allocator.store(subnet_id, version + 1, ranges)
+        self.logger.debug("Allocated %s ips on subnet: %s" % (count, subnet_id))
+        return [{
+            'id': ip['id'],
+            'ip': ip['ip'],
+            'subnet': cidr,
+            'subnet_id': subnet_id,
+            'interface_id': None,
+            'hostname': None,
+        } for ip in ips]
+
+    def ip_create_many(self, items):
+        """Creates the ips described by items, dicts like the ones taken by
+        ip_create, in one transaction. Subnets are read and locked once for
+        the whole batch. Returns, in the same order, each created ip or the
+        error that kept it from being created."""
+        self.logger.debug("Creating %s ips" % len(items))
+        results = [None] * len(items)
+        keys = {}
+        for i, item in enumerate(items):
+            try:
+                if not isinstance(item['subnet_id'], basestring):
+                    results[i] = _invalid_('Ip', item)
+                    continue
+                keys[i] = address_key(item['ip'])
+            except (TypeError, KeyError, ValueError):
+                results[i] = _invalid_('Ip', item)
+
+        self.session.begin(subtransactions=True)
+        try:
+            subnets = {}
+            for chunk in _chunks_(sorted(set(items[i]['subnet_id'] for i in keys))):
+                ss = self.session.query(
+                    Subnet.id, Subnet.cidr, Subnet.net_start, Subnet.net_end
+                ).filter(Subnet.id.in_(chunk)).order_by(Subnet.id)
+                subnets.update((x.id, x) for x in ss.with_lockmode('update'))
+            taken = set()
+            for chunk in _chunks_(set(keys.values())):
+                ss = self.session.query(Ip.address).filter(Ip.address.in_(chunk))
+                taken.update(x.address for x in ss)
+
+            rows = []
+            for i in sorted(keys):
+                ip, key = items[i]['ip'], keys[i]
+                subnet = subnets.get(items[i]['subnet_id'])
+                if subnet is None:
+                    results[i] = OperationNotPermited(
+                        'Ip', "subnet_id %s doesnt exist" % items[i]['subnet_id']
+                    ).output
+                elif not subnet.net_start <= key <= subnet.net_end:
+                    results[i] = OperationNotPermited(
+                        'Ip', "%s address must be contained in %s" % (ip, subnet.cidr)
+                    ).output
+                elif key in taken:
+                    results[i] = DuplicatedEntryError(
+                        'Ip', "%s already exists" % ip
+                    ).output
+                else:
+                    taken.add(key)
+                    row = {
+                        'id': str(uuid.uuid4()),
+                        'ip': ip,
+                        'address': key,
+                        'subnet_id': subnet.id,
+                    }
+                    rows.append(row)
+                    results[i] = {
+                        'id': row['id'],
+                        'ip': ip,
+                        'subnet': subnet.cidr,
+                        'subnet_id': subnet.id,
+                        'interface_id': None,
+                        'hostname': None,
+                    }
+            if rows:
+                self.session.execute(Ip.__table__.insert(), rows)
+                for chunk in _chunks_(set(row['subnet_id'] for row in rows)):
+                    self.session.query(Subnet).filter(Subnet.id.in_(chunk)).update(
+                        {'allocation_version': func.coalesce(Subnet.allocation_version, 0) + 1},
+                        synchronize_session=False
+                    )
+            self.session.commit()
+        except:
+            self.session.rollback()
+            raise
+        self.logger.debug("Created %s of %s ips" % (len(rows), len(items)))
+        return results
+
     def anycastip_create(self, anycast_id, data):
         self.logger.debug("Creating ip on anycast: %s using data: %s" %
             (anycast_id, data)
@@ -600,9 +942,79 @@ class SimpleNet(object):
         except:
             self.logger.exception("Failed to delete IP")
             raise
-        val = self._generic_delete_("Ip", {'id': id})
+        self.session.begin(subtransactions=True)
+        try:
+            self._touch_subnet_(ip['subnet_id'])
+            val = self._generic_delete_("Ip", {'id': id})
+            self.session.commit()
+        except:
+            self.session.rollback()
+            raise
         return val
 
+    def ip_delete_many(self, ids):
+        """Deletes the ips with the given ids, returning True or the error
+        of each one, in the same order. Ips plugged to an interface go
+        through ip_delete, the others and their policies are deleted in one
+        transaction. Firewall updates are sent once, at the end."""
+        import simplenet.network_appliances.firewall
+        results = [None] * len(ids)
+        found = {}
+        for chunk in _chunks_(set(ids)):
+            ss = self.session.query(Ip.id, Ip.subnet_id, Ip.interface_id)
+            found.update((x.id, x) for x in ss.filter(Ip.id.in_(chunk)))
+
+        with event.EventBatch():
+            plain = set()
+            for i, id in enumerate(ids):
+                ip = found.get(id)
+                if ip is None:
+                    results[i] = EntityNotFound('Ip', id).output
+                elif ip.interface_id is not None and id not in plain:
+                    try:
+                        results[i] = self.ip_delete(id)
+                    except SimpleNetError, e:
+                        results[i] = e.output
+                    except Exception, e:
+                        results[i] = OperationFailed(str(e)).output
+                    found.pop(id)
+                else:
+                    plain.add(id)
+                    results[i] = True
+            if not plain:
+                return results
+
+            # Rules are resolved while the ips still exist
+            pol = simplenet.network_appliances.firewall.Net()
+            model, ss, serialize = pol._generic_query_("IpPolicy")
+            for chunk in _chunks_(plain):
+                rows = ss.filter(IpPolicy.owner_id.in_(chunk))
+                for policy in list(serialize(rows)):
+                    pol._enqueue_rules_('ip', policy['owner_id'], policy)
+
+            self.session.begin(subtransactions=True)
+            try:
+                for chunk in _chunks_(plain):
+                    self.session.query(IpPolicy).filter(
+                        IpPolicy.owner_id.in_(chunk)
+                    ).delete(synchronize_session=False)
+                    self.session.query(Ip).filter(
+                        Ip.id.in_(chunk)
+                    ).delete(synchronize_session=False)
+                subnets = set(found[id].subnet_id for id in plain)
+                for chunk in _chunks_(subnets):
+                    self.session.query(Subnet).filter(Subnet.id.in_(chunk)).update(
+                        {'allocation_version': func.coalesce(Subnet.allocation_version, 0) + 1},
+                        synchronize_session=False
+                    )
+                self.session.commit()
+            except:
+                self.session.rollback()
+                raise
+            _forget_ancestry_(plain, descendants=False)
+        self.logger.debug("Deleted %s ips" % len(plain))
+        return results
+
     def anycastip_delete(self, id):
         return self._generic_delete_("Anycastip", {'id': id})
 
@@ -621,8 +1033,8 @@ class SimpleNet(object):
     def policy_delete(self, *args, **kawrgs):
         raise FeatureNotAvailable()
 
-    def interface_list(self):
-        return self._generic_list_("Interface")
+    def interface_list(self, **kwargs):
+        return self._generic_list_("Interface", **kwargs)
 
     def interface_create(self, data):
         self.logger.debug("Creating interface using data: %s" % data)
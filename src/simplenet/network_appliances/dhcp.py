@@ -53,8 +53,8 @@ class Net(SimpleNet):
 
         return self.dhcp_info_by_name(data['name'])
 
-    def dhcp_list(self):
-        return self._generic_list_("Dhcp")
+    def dhcp_list(self, **kwargs):
+        return self._generic_list_("Dhcp", **kwargs)
 
     def dhcp_rebuild_queues(self, vlan_id):
         self.logger.debug("Rebuilding queue for %s" %
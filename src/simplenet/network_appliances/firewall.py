@@ -17,38 +17,104 @@
 # @author: Luiz Ozaki, Locaweb.
 
 import json
+import uuid
+
 from simplenet.common import event
 from simplenet.common.config import get_logger
-from simplenet.db.models import new_model, Firewall, Anycast, Anycasts_to_Firewall
+from simplenet.db.models import (
+        new_model, cidr_gateway, cidr_network, Datacenter, Zone, Vlan,
+        Subnet, Ip, Interface, Firewall, FirewallRuleset, Anycast, Anycastip,
+        Anycasts_to_Firewall, Policy
+)
 from simplenet.db import db_utils
 from simplenet.exceptions import (
     FeatureNotAvailable, EntityNotFound,
     OperationNotPermited, DuplicatedEntryError
 )
+from simplenet.network_appliances.base import _chunks_, _invalid_
 from simplenet.network_appliances.base import SimpleNet
 
+from sqlalchemy import or_
 from sqlalchemy.exc import IntegrityError
 
 logger = get_logger()
-session = db_utils.get_database_session()
+session = db_utils.get_scoped_session()
+
+# Fields given on policy creation and the ones identifying a policy
+POLICY_FIELDS = (
+    'proto', 'src', 'src_port', 'dst', 'dst_port', 'table', 'policy',
+    'in_iface', 'out_iface'
+)
+POLICY_UNIQUE = POLICY_FIELDS + ('owner_type', 'owner_id')
+
+
+
+def _policy_owner_(item):
+    """Whether owner_type on a bulk policy item names a kind of policy"""
+    owner_type = item.get('owner_type')
+    if not isinstance(owner_type, basestring) or not owner_type:
+        return False
+    try:
+        model, _ = new_model("%sPolicy" % owner_type.capitalize())
+    except KeyError:
+        return False
+    return model is not Policy
+
+
+RULESET_SECTIONS = {
+    'policy': 'id',
+    'vlans': 'vlan_id',
+    'subnets': 'id',
+    'ips': 'id',
+    'anycasts': 'anycast_id',
+    'anycastips': 'id',
+}
+
+
+def _ruleset_state_(data):
+    """Flattens a firewall payload into sections indexed by entity id, the
+    form rulesets are stored and diffed in"""
+    state = dict((section, {}) for section in RULESET_SECTIONS)
+    for vlan in data['vlans']:
+        for subnet in vlan['subnets']:
+            for ip in subnet['ips']:
+                state['ips'][ip['id']] = ip
+            subnet = dict(subnet)
+            del subnet['ips']
+            state['subnets'][subnet['id']] = subnet
+        vlan = dict(vlan)
+        del vlan['subnets']
+        state['vlans'][vlan['vlan_id']] = vlan
+    for section in ('policy', 'anycasts', 'anycastips'):
+        key = RULESET_SECTIONS[section]
+        for entry in data[section]:
+            state[section][entry[key]] = entry
+    return state
+
+
+def _ruleset_delta_(old, new):
+    """Returns the entries added (or changed) and the ids removed on each
+    section, ignoring policy status changes"""
+    def differs(a, b):
+        return a != b and dict(a, status=None) != dict(b, status=None)
+
+    delta = {}
+    for section in RULESET_SECTIONS:
+        _old, _new = old.get(section, {}), new[section]
+        added = [entry for key, entry in _new.iteritems()
+                 if key not in _old or differs(_old[key], entry)]
+        removed = [key for key in _old if key not in _new]
+        if added or removed:
+            delta[section] = {'added': added, 'removed': removed}
+    return delta
+
 
 class Net(SimpleNet):
 
     def _get_data_firewall_(self, id):
         logger.debug("Getting device data %s" % id)
         firewall = self.firewall_info(id)
-        zone = self.zone_info(firewall['zone_id'])
-        datacenter = self.datacenter_info(zone['datacenter_id'])
-        logger.debug("Received device: %s zone: %s "
-            "datacenter: %s from [%s]" %
-            (firewall, zone, datacenter, id)
-        )
-        return {
-            'zone': zone['name'],
-            'zone_id': zone['id'],
-            'datacenter': datacenter['name'],
-            'datacenter_id': datacenter['id'],
-        }
+        return self._get_ancestry_('zone', firewall['zone_id'])
 
     def firewall_enable(self, data):
         session.begin()
@@ -99,8 +165,8 @@ class Net(SimpleNet):
 
         return self.firewall_info_by_name(data['name'])
 
-    def firewall_list(self):
-        return self._generic_list_("Firewall")
+    def firewall_list(self, **kwargs):
+        return self._generic_list_("Firewall", **kwargs)
 
     def firewall_add_anycast(self, firewall_id, data):
         logger.debug("Adding vlan to anycast: %s using data: %s" %
@@ -173,7 +239,7 @@ class Net(SimpleNet):
         if device is None:
             raise EntityNotFound("Firewall", "not found with %s" % data)
 
-        self._enqueue_device_rules_(_data, [device], "FW Reload")
+        self._enqueue_device_rules_(_data, [device], "FW Reload", full=True)
 
         return device
 
@@ -189,27 +255,31 @@ class Net(SimpleNet):
         if devices is None:
             raise EntityNotFound("Zone", "not found with %s" % data)
 
-        self._enqueue_device_rules_(_data, devices, "FW Reload")
+        self._enqueue_device_rules_(_data, devices, "FW Reload", full=True)
 
         return devices
 
     def _enqueue_rules_(self, owner_type, owner_id, mod):
         logger.debug("Getting rules from %s with id %s" % (owner_type, owner_id))
-        policy_list = []
-        _get_data = getattr(self, "_get_data_%s_" % owner_type)
-        zone_id = _get_data(owner_id).get('zone_id')
+        if owner_type in ('ip', 'subnet', 'vlan', 'zone'):
+            zone_id = self._get_ancestry_(owner_type, owner_id).get('zone_id')
+        else:
+            _get_data = getattr(self, "_get_data_%s_" % owner_type)
+            zone_id = _get_data(owner_id).get('zone_id')
         _data = {}
-        #_data = _get_data(owner_id)
         _data['modified'] = mod
 
+        event.defer(('firewall', zone_id), self._enqueue_zone_rules_,
+                    zone_id, _data, owner_type)
+
+    def _enqueue_zone_rules_(self, zone_id, data, owner_type):
         logger.debug("Getting devices by zone: %s" % zone_id)
         devices = self.firewall_list_by_zone(zone_id)
 
-        self._enqueue_device_rules_(_data, devices, owner_type)
+        self._enqueue_device_rules_(data, devices, owner_type)
 
-    def _enqueue_device_rules_(self, data, devices, owner_type):
-        policy_list = []
-        cache = {}
+    def _enqueue_device_rules_(self, data, devices, owner_type, full=False):
+        zones = {}
         try:
             devices = devices.split()
         except AttributeError:
@@ -220,49 +290,228 @@ class Net(SimpleNet):
                 logger.info("Device %s ignored, status disabled" % device.get("name"))
                 continue
             logger.debug("Getting data from device: %s" % device['id'])
-            owners_ids = []
             zone_id = device['zone_id']
+            dev_id = device.get('device_id') or device.get('id')
 
-            if cache.get(zone_id):
-                logger.info("Sending cached event to %s" % device['name'])
-                event.EventManager().raise_event(device['name'], cache.get(zone_id))
+            if zone_id in zones:
+                logger.info("Using cached zone %s snapshot for %s" % (zone_id, device['name']))
             else:
-                _data = data
-                _data.update(self._get_data_zone_(zone_id))
-                _data['anycasts'] = []
-                _data['anycastips'] = []
-                dev_id = device.get('device_id') or device.get('id')
-
-                logger.debug("Getting policy data from zone %s" % zone_id)
-                policy_list += self.policy_list_by_owner('zone', zone_id)
-                for vlan in self.vlan_list_by_zone(zone_id): # Cascade thru the vlans of the device
-                    owners_ids.append(vlan['id'])
-                    for subnet in self.subnet_list_by_vlan(vlan['id']): # Cascade thru the subnets of the vlan
-                        owners_ids.append(subnet['id'])
-                        for ip in self.ip_list_by_subnet(subnet['id']): # Cascade thru the IPs of the subnet
-                            owners_ids.append(ip['id'])
-
-                for anycast in self.anycast_list_by_firewall(dev_id): # Cascade thru the anycasts of the device
-                    owners_ids.append(anycast['anycast_id'])
-                    _data['anycasts'].append(anycast)
-                    for anycastip in self.anycastip_list_by_anycast(anycast['anycast_id']): # Cascade thru the IPs of the anycast subnet
-                        _data['anycastips'].append(anycastip)
-                        owners_ids.append(anycastip['id'])
-
-                logger.debug("Getting policy data")
-                policy_list += self.policy_list_by_owners(owners_ids)
-
-                _data.update({'policy': policy_list})
-                logger.debug("Received rules: %s from %s with id %s and device %s" % (
-                    _data, owner_type, _data.get('modified', {}).get('id'), device['name'])
-                )
-                if policy_list:
-                    logger.info("Sending event to %s" % device['name'])
-                    cache[zone_id] = _data
-                    event.EventManager().raise_event(device['name'], _data)
+                zones[zone_id] = self._get_zone_snapshot_(zone_id)
+            zone = zones[zone_id]
+            anycasts = self._get_device_snapshot_(dev_id)
+
+            _data = dict(data)
+            _data.update(zone)
+            _data.update(anycasts)
+            _data['policy'] = zone['policy'] + anycasts['policy']
+            logger.debug("Received %s rules from %s with id %s and device %s" % (
+                len(_data['policy']), owner_type, _data.get('modified', {}).get('id'), device['name'])
+            )
+            _data = self._ruleset_payload_(dev_id, _data, full)
+            if _data:
+                logger.info("Sending event to %s" % device['name'])
+                event.EventManager().raise_event(device['name'], _data)
+
+    def _ruleset_payload_(self, dev_id, data, full=False):
+        """Records the ruleset being sent to the device and returns the
+        payload for it, a delta against the last version the device got
+        unless a full payload is asked for or there is nothing to diff
+        against. Returns None if there is nothing to send."""
+        state = _ruleset_state_(data)
+        session.begin(subtransactions=True)
+        try:
+            ruleset = session.query(FirewallRuleset).with_lockmode('update').get(dev_id)
+            if ruleset is None:
+                ruleset = FirewallRuleset(dev_id)
+                session.add(ruleset)
+
+            if full or not ruleset.state:
+                payload = data if data['policy'] else None
+            else:
+                delta = _ruleset_delta_(json.loads(ruleset.state), state)
+                payload = None
+                if delta:
+                    payload = dict((key, value) for key, value in data.iteritems()
+                                   if key not in RULESET_SECTIONS)
+                    payload['base_version'] = ruleset.version
+                    payload['delta'] = delta
+
+            if payload is not None:
+                ruleset.version += 1
+                ruleset.state = json.dumps(state)
+                payload['version'] = ruleset.version
+            session.commit()
+        except Exception, e:
+            session.rollback()
+            raise Exception(e)
+
+        if payload is not None:
+            logger.debug("Ruleset %s version %s for %s" % (
+                'delta' if 'delta' in payload else 'full', payload['version'], dev_id)
+            )
+        return payload
+
+    def _get_zone_snapshot_(self, zone_id):
+        logger.debug("Getting zone snapshot %s" % zone_id)
+        zone = session.query(
+            Zone.id, Zone.name, Datacenter.id, Datacenter.name
+        ).join(Datacenter, Zone.datacenter_id == Datacenter.id).filter(
+            Zone.id == zone_id
+        ).first()
+        if not zone:
+            raise EntityNotFound('Zone', zone_id)
+        zone_id, zone_name, datacenter_id, datacenter_name = zone
+
+        vlans_query = session.query(Vlan.id).filter(Vlan.zone_id == zone_id)
+        subnets_query = session.query(Subnet.id).join(
+            Vlan, Subnet.vlan_id == Vlan.id
+        ).filter(Vlan.zone_id == zone_id)
+        ips_query = session.query(Ip.id).join(
+            Subnet, Ip.subnet_id == Subnet.id
+        ).join(Vlan, Subnet.vlan_id == Vlan.id).filter(Vlan.zone_id == zone_id)
+
+        owners = {zone_id: zone_name}
+        vlans = []
+        vlans_by_id = {}
+        for vlan_id, name in session.query(Vlan.id, Vlan.name).filter(
+                Vlan.zone_id == zone_id):
+            owners[vlan_id] = name
+            vlans_by_id[vlan_id] = {
+                'vlan': name,
+                'vlan_id': vlan_id,
+                'zone': zone_name,
+                'zone_id': zone_id,
+                'datacenter': datacenter_name,
+                'datacenter_id': datacenter_id,
+                'subnets': [],
+            }
+            vlans.append(vlans_by_id[vlan_id])
+
+        subnets_by_id = {}
+        for subnet_id, cidr, vlan_id in session.query(
+                Subnet.id, Subnet.cidr, Subnet.vlan_id).join(
+                Vlan, Subnet.vlan_id == Vlan.id).filter(Vlan.zone_id == zone_id):
+            owners[subnet_id] = cidr
+            subnets_by_id[subnet_id] = {
+                'id': subnet_id,
+                'cidr': cidr,
+                'vlan': vlans_by_id[vlan_id]['vlan'],
+                'vlan_id': vlan_id,
+                'gateway': cidr_gateway(cidr),
+                'network': cidr_network(cidr),
+                'ips': [],
+            }
+            vlans_by_id[vlan_id]['subnets'].append(subnets_by_id[subnet_id])
+
+        for ip_id, ip, subnet_id, interface_id, hostname in session.query(
+                Ip.id, Ip.ip, Ip.subnet_id, Ip.interface_id, Interface.hostname
+                ).join(Subnet, Ip.subnet_id == Subnet.id).join(
+                Vlan, Subnet.vlan_id == Vlan.id).outerjoin(
+                Interface, Ip.interface_id == Interface.id).filter(
+                Vlan.zone_id == zone_id):
+            owners[ip_id] = ip
+            subnets_by_id[subnet_id]['ips'].append({
+                'id': ip_id,
+                'ip': ip,
+                'subnet': subnets_by_id[subnet_id]['cidr'],
+                'subnet_id': subnet_id,
+                'interface_id': interface_id,
+                'hostname': hostname,
+            })
+
+        policies = self._policy_snapshot_(owners, or_(
+            Policy.owner_id == zone_id,
+            Policy.owner_id.in_(vlans_query.subquery()),
+            Policy.owner_id.in_(subnets_query.subquery()),
+            Policy.owner_id.in_(ips_query.subquery()),
+        ))
+        # Zone policies go first, as they did when fetched on their own
+        policies.sort(key=lambda policy: policy['owner_id'] != zone_id)
 
-    def policy_list(self, owner_type):
-        return self._generic_list_("%sPolicy" % owner_type.capitalize())
+        return {
+            'zone': zone_name,
+            'zone_id': zone_id,
+            'datacenter': datacenter_name,
+            'datacenter_id': datacenter_id,
+            'vlans': vlans,
+            'policy': policies,
+        }
+
+    def _get_device_snapshot_(self, dev_id):
+        logger.debug("Getting device snapshot %s" % dev_id)
+        anycasts_query = session.query(Anycasts_to_Firewall.anycast_id).filter(
+            Anycasts_to_Firewall.firewall_id == dev_id
+        )
+        anycastips_query = session.query(Anycastip.id).join(
+            Anycasts_to_Firewall,
+            Anycastip.anycast_id == Anycasts_to_Firewall.anycast_id
+        ).filter(Anycasts_to_Firewall.firewall_id == dev_id)
+
+        owners = {}
+        anycasts = []
+        for anycast_id, cidr in session.query(
+                Anycasts_to_Firewall.anycast_id, Anycast.cidr).join(
+                Anycast, Anycasts_to_Firewall.anycast_id == Anycast.id).filter(
+                Anycasts_to_Firewall.firewall_id == dev_id):
+            owners[anycast_id] = cidr
+            anycasts.append({'anycast_id': anycast_id, 'anycast_cidr': cidr})
+
+        anycastips = []
+        for anycastip_id, ip, anycast_id, cidr in session.query(
+                Anycastip.id, Anycastip.ip, Anycastip.anycast_id, Anycast.cidr
+                ).join(Anycast, Anycastip.anycast_id == Anycast.id).join(
+                Anycasts_to_Firewall,
+                Anycastip.anycast_id == Anycasts_to_Firewall.anycast_id).filter(
+                Anycasts_to_Firewall.firewall_id == dev_id):
+            owners[anycastip_id] = ip
+            anycastips.append({
+                'id': anycastip_id,
+                'ip': ip,
+                'anycast': cidr,
+                'anycast_id': anycast_id,
+            })
+
+        policies = []
+        if owners:
+            policies = self._policy_snapshot_(owners, or_(
+                Policy.owner_id.in_(anycasts_query.subquery()),
+                Policy.owner_id.in_(anycastips_query.subquery()),
+            ))
+
+        return {
+            'anycasts': anycasts,
+            'anycastips': anycastips,
+            'policy': policies,
+        }
+
+    def _policy_snapshot_(self, owners, criterion):
+        policies = []
+        for row in session.query(
+                Policy.id, Policy.owner_id, Policy.owner_type, Policy.proto,
+                Policy.src, Policy.src_port, Policy.dst, Policy.dst_port,
+                Policy.table, Policy.policy, Policy.status, Policy.in_iface,
+                Policy.out_iface).filter(criterion):
+            policy = {
+                'id': row.id,
+                'owner_id': row.owner_id,
+                'proto': row.proto,
+                'src': row.src,
+                'src_port': row.src_port,
+                'dst': row.dst,
+                'dst_port': row.dst_port,
+                'table': row.table,
+                'policy': row.policy,
+                'status': row.status,
+                'owner': owners.get(row.owner_id),
+            }
+            if row.owner_type == 'ip':
+                policy['in_iface'] = row.in_iface
+                policy['out_iface'] = row.out_iface
+            policies.append(policy)
+        return policies
+
+    def policy_list(self, owner_type, **kwargs):
+        return self._generic_list_("%sPolicy" % owner_type.capitalize(), **kwargs)
 
     def policy_create(self, owner_type, owner_id, data):
         logger.debug("Creating rule on %s: %s using data: %s" %
@@ -289,6 +538,70 @@ class Net(SimpleNet):
         pol = self.policy_info(owner_type, policy.id)
         return pol
 
+    def policy_create_many(self, items):
+        """Creates the policies described by items, dicts with the owner_type
+        and owner_id of the policy besides the fields taken by policy_create,
+        in one transaction. Returns, in the same order, each created policy
+        or the error that kept it from being created."""
+        logger.debug("Creating %s policies" % len(items))
+        results = [None] * len(items)
+        rows = {}
+        for i, item in enumerate(items):
+            try:
+                if not _policy_owner_(item):
+                    results[i] = _invalid_('Firewall', item)
+                    continue
+                row = dict((field, item.get(field, '')) for field in POLICY_FIELDS)
+                row['owner_id'] = item['owner_id']
+                if not all(isinstance(v, basestring) for v in row.values()):
+                    results[i] = _invalid_('Firewall', item)
+                    continue
+                row.update({
+                    'id': str(uuid.uuid4()),
+                    'owner_type': item['owner_type'],
+                    'status': 'PENDING',
+                })
+                rows[i] = row
+            except (TypeError, KeyError, AttributeError):
+                results[i] = _invalid_('Firewall', item)
+
+        unique = lambda row: tuple(row[field] for field in POLICY_UNIQUE)
+        session.begin(subtransactions=True)
+        try:
+            taken = set()
+            for chunk in _chunks_(set(row['owner_id'] for row in rows.values())):
+                ss = session.query(*[getattr(Policy, field) for field in POLICY_UNIQUE])
+                taken.update(unique(x) for x in ss.filter(Policy.owner_id.in_(chunk)))
+            created = []
+            for i in sorted(rows):
+                if unique(rows[i]) in taken:
+                    results[i] = DuplicatedEntryError(
+                        'Firewall', "%s already exists" % items[i]
+                    ).output
+                else:
+                    taken.add(unique(rows[i]))
+                    created.append(rows[i])
+            if created:
+                session.execute(Policy.__table__.insert(), created)
+            session.commit()
+        except:
+            session.rollback()
+            raise
+
+        by_type = {}
+        for i in rows:
+            if results[i] is None:
+                by_type.setdefault(rows[i]['owner_type'], {})[rows[i]['id']] = i
+        for owner_type, indexes in by_type.iteritems():
+            model, ss, serialize = self._generic_query_(
+                "%sPolicy" % owner_type.capitalize()
+            )
+            for chunk in _chunks_(indexes):
+                for policy in serialize(ss.filter(Policy.id.in_(chunk))):
+                    results[indexes[policy['id']]] = policy
+        logger.debug("Created %s of %s policies" % (len(created), len(items)))
+        return results
+
     def policy_ack(self, id):
         _model, _ = new_model("Policy")
         ss = session.query(_model).get(id)
@@ -303,6 +616,27 @@ class Net(SimpleNet):
                 session.rollback()
                 raise e
 
+    def policy_ack_many(self, ids):
+        """Marks the policies with the given ids as inserted, a chunk at a
+        time, in one transaction"""
+        ids = set(ids)
+        session.begin(subtransactions=True)
+        try:
+            acked = 0
+            for chunk in _chunks_(ids):
+                acked += session.query(Policy).filter(Policy.id.in_(chunk)).update(
+                    {'status': 'INSERTED'}, synchronize_session=False
+                )
+            session.commit()
+        except:
+            session.rollback()
+            raise
+        if acked < len(ids):
+            logger.error("%s of %s policies could not be acked -- Not Found" % (
+                len(ids) - acked, len(ids)
+            ))
+        return acked
+
     def policy_info(self, owner_type, id):
         return self._generic_info_("%sPolicy" % owner_type.capitalize(), {'id': id})
 
@@ -329,6 +663,46 @@ class Net(SimpleNet):
 
         return True
 
+    def policy_delete_many(self, items):
+        """Deletes the policies described by items, dicts with the owner_type
+        and id of each policy, in one transaction. Returns, in the same
+        order, True or the error of each one."""
+        results = [None] * len(items)
+        by_type = {}
+        for i, item in enumerate(items):
+            try:
+                if not _policy_owner_(item) or not isinstance(item['id'], basestring):
+                    results[i] = _invalid_('Firewall', item)
+                    continue
+                by_type.setdefault(item['owner_type'], set()).add(item['id'])
+            except (TypeError, KeyError, AttributeError):
+                results[i] = _invalid_('Firewall', item)
+
+        found = {}
+        session.begin(subtransactions=True)
+        try:
+            for owner_type, ids in by_type.iteritems():
+                found[owner_type] = set()
+                for chunk in _chunks_(ids):
+                    criteria = (Policy.owner_type == owner_type) & Policy.id.in_(chunk)
+                    ss = session.query(Policy.id).filter(criteria)
+                    found[owner_type].update(x.id for x in ss)
+                    session.query(Policy).filter(criteria).delete(
+                        synchronize_session=False
+                    )
+            session.commit()
+        except:
+            session.rollback()
+            raise
+        for i, item in enumerate(items):
+            if results[i] is None:
+                if item['id'] in found[item['owner_type']]:
+                    results[i] = True
+                else:
+                    results[i] = EntityNotFound('Policy', item['id']).output
+        logger.debug("Deleted %s policies" % sum(len(x) for x in found.values()))
+        return results
+
     def policy_delete_by_owner(self, owner_type, id):
         _model, _ = new_model("%sPolicy" % owner_type.capitalize())
         ss = session.query(_model).filter_by(**{'owner_id': id}).all()
@@ -344,8 +718,9 @@ class Net(SimpleNet):
                 session.rollback()
                 raise Exception(e)
 
-            for modified in entries:
-                self._enqueue_rules_(owner_type, id, modified)
+            with event.EventBatch():
+                for modified in entries:
+                    self._enqueue_rules_(owner_type, id, modified)
 
     def policy_list_by_owner(self, owner_type, id):
         return self._generic_list_by_something_(
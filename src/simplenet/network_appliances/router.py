@@ -30,7 +30,7 @@ from simplenet.network_appliances.base import SimpleNet
 from sqlalchemy.exc import IntegrityError
 
 logger = get_logger()
-session = db_utils.get_database_session()
+session = db_utils.get_scoped_session()
 
 class Net(SimpleNet):
 
@@ -99,8 +99,8 @@ class Net(SimpleNet):
 
         return self.router_info_by_name(data['name'])
 
-    def router_list(self):
-        return self._generic_list_("Router")
+    def router_list(self, **kwargs):
+        return self._generic_list_("Router", **kwargs)
 
     def router_list_by_vlan(self, vlan_id):
         return self._generic_list_by_something_(
@@ -29,12 +29,12 @@ from simplenet.network_appliances.base import SimpleNet
 from sqlalchemy.exc import IntegrityError
 
 logger = get_logger()
-session = db_utils.get_database_session()
+session = db_utils.get_scoped_session()
 
 
 class Net(SimpleNet):
-    def switch_list(self):
-        return self._generic_list_("Switch")
+    def switch_list(self, **kwargs):
+        return self._generic_list_("Switch", **kwargs)
 
     def switch_create(self, data):
         logger.debug("Creating device using data: %s" % data)
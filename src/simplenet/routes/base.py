@@ -21,11 +21,16 @@ import json
 from bottle import abort, delete, get, post
 from bottle import request, response
 
+from simplenet.common import event
 from simplenet.common.auth import handle_auth
 from simplenet.common.config import get_logger
 from simplenet.common.http_utils import (
-    reply_json, create_manager, validate_input, clear_cache, cache
+    reply_json, create_manager, validate_input, clear_cache, cache,
+    bulk_input, cache_stats,
+    paginated
 )
+from simplenet.db import models
+from simplenet.db.pool import pool_stats
 from simplenet.exceptions import (
     FeatureNotAvailable
 )
@@ -78,11 +83,30 @@ def generic_prober():
         raise FeatureNotAvailable()
 
 
+@get('/v1/stats')
+@handle_auth
+@reply_json
+def generic_stats():
+    """
+    ::
+
+      GET /v1/stats
+
+    Retrieves the server internal counters
+    """
+    return {
+        'events': event.get_publisher().stats(),
+        'cache': cache_stats(),
+        'database': pool_stats(models.engine),
+    }
+
+
 @get('/v1/datacenters')
 @handle_auth
 @reply_json
-@cache()
-def datacenters_list():
+@paginated
+@cache('datacenters')
+def datacenters_list(**kwargs):
     """
     ::
 
@@ -93,7 +117,7 @@ def datacenters_list():
     manager = create_manager('base')
     try:
         _list = getattr(manager, 'datacenter_list')
-        return _list()
+        return _list(**kwargs)
     except AttributeError:
         raise FeatureNotAvailable()
 
@@ -101,8 +125,9 @@ def datacenters_list():
 @get('/v1/zones')
 @handle_auth
 @reply_json
-@cache()
-def zone_list():
+@paginated
+@cache('zones')
+def zone_list(**kwargs):
     """
     ::
 
@@ -113,7 +138,7 @@ def zone_list():
     manager = create_manager('base')
     try:
         _list = getattr(manager, 'zone_list')
-        return _list()
+        return _list(**kwargs)
     except AttributeError:
         raise FeatureNotAvailable()
 
@@ -121,8 +146,9 @@ def zone_list():
 @get('/v1/vlans')
 @handle_auth
 @reply_json
-@cache()
-def vlan_list():
+@paginated
+@cache('vlans')
+def vlan_list(**kwargs):
     """
     ::
 
@@ -133,7 +159,7 @@ def vlan_list():
     manager = create_manager('base')
     try:
         _list = getattr(manager, 'vlan_list')
-        return _list()
+        return _list(**kwargs)
     except AttributeError:
         raise FeatureNotAvailable()
 
@@ -141,8 +167,9 @@ def vlan_list():
 @get('/v1/subnets')
 @handle_auth
 @reply_json
-@cache()
-def subnet_list():
+@paginated
+@cache('subnets')
+def subnet_list(**kwargs):
     """
     ::
 
@@ -153,7 +180,7 @@ def subnet_list():
     manager = create_manager('base')
     try:
         _list = getattr(manager, 'subnet_list')
-        return _list()
+        return _list(**kwargs)
     except AttributeError:
         raise FeatureNotAvailable()
 
@@ -161,8 +188,9 @@ def subnet_list():
 @get('/v1/anycasts')
 @handle_auth
 @reply_json
-@cache()
-def anycast_list():
+@paginated
+@cache('anycasts')
+def anycast_list(**kwargs):
     """
     ::
 
@@ -173,7 +201,7 @@ def anycast_list():
     manager = create_manager('base')
     try:
         _list = getattr(manager, 'anycast_list')
-        return _list()
+        return _list(**kwargs)
     except AttributeError:
         raise FeatureNotAvailable()
 
@@ -181,8 +209,9 @@ def anycast_list():
 @get('/v1/ips')
 @handle_auth
 @reply_json
-@cache()
-def ip_list():
+@paginated
+@cache('ips')
+def ip_list(**kwargs):
     """
     ::
 
@@ -193,7 +222,7 @@ def ip_list():
     manager = create_manager('base')
     try:
         _list = getattr(manager, 'ip_list')
-        return _list()
+        return _list(**kwargs)
     except AttributeError:
         raise FeatureNotAvailable()
 
@@ -201,8 +230,9 @@ def ip_list():
 @get('/v1/anycastips')
 @handle_auth
 @reply_json
-@cache()
-def anycastip_list():
+@paginated
+@cache('anycastips')
+def anycastip_list(**kwargs):
     """
     ::
 
@@ -213,7 +243,7 @@ def anycastip_list():
     manager = create_manager('base')
     try:
         _list = getattr(manager, 'anycastip_list')
-        return _list()
+        return _list(**kwargs)
     except AttributeError:
         raise FeatureNotAvailable()
 
@@ -221,8 +251,9 @@ def anycastip_list():
 @get('/v1/dhcps')
 @handle_auth
 @reply_json
-@cache()
-def dhcp_list():
+@paginated
+@cache('dhcps')
+def dhcp_list(**kwargs):
     """
     ::
 
@@ -233,7 +264,7 @@ def dhcp_list():
     manager = create_manager('dhcp')
     try:
         _list = getattr(manager, 'dhcp_list')
-        return _list()
+        return _list(**kwargs)
     except AttributeError:
         raise FeatureNotAvailable()
 
@@ -241,8 +272,9 @@ def dhcp_list():
 @get('/v1/interfaces')
 @handle_auth
 @reply_json
-@cache()
-def interface_list():
+@paginated
+@cache('interfaces')
+def interface_list(**kwargs):
     """
     ::
 
@@ -253,7 +285,7 @@ def interface_list():
     manager = create_manager('base')
     try:
         _list = getattr(manager, 'interface_list')
-        return _list()
+        return _list(**kwargs)
     except AttributeError:
         raise FeatureNotAvailable()
 
@@ -261,8 +293,9 @@ def interface_list():
 @get('/v1/firewalls')
 @handle_auth
 @reply_json
-@cache()
-def firewall_list():
+@paginated
+@cache('firewalls')
+def firewall_list(**kwargs):
     """
     ::
 
@@ -273,7 +306,7 @@ def firewall_list():
     manager = create_manager('firewall')
     try:
         _list = getattr(manager, 'firewall_list')
-        return _list()
+        return _list(**kwargs)
     except AttributeError:
         raise FeatureNotAvailable()
 
@@ -281,8 +314,9 @@ def firewall_list():
 @get('/v1/routers')
 @handle_auth
 @reply_json
-@cache()
-def router_list():
+@paginated
+@cache('routers')
+def router_list(**kwargs):
     """
     ::
 
@@ -293,7 +327,7 @@ def router_list():
     manager = create_manager('router')
     try:
         _list = getattr(manager, 'router_list')
-        return _list()
+        return _list(**kwargs)
     except AttributeError:
         raise FeatureNotAvailable()
 
@@ -374,13 +408,14 @@ def generic_resource_delete(resource, resource_id):
 
     Deletes resource
     """
-    clear_cache()
     manager = create_manager(generic_router(resource))
     try:
         _delete = getattr(manager, '%s_delete' % (resource_map.get(resource)))
-        return _delete(resource_id)
+        result = _delete(resource_id)
     except AttributeError:
         raise FeatureNotAvailable()
+    clear_cache(resource)
+    return result
 
 
 @post('/v1/datacenters')
@@ -403,7 +438,7 @@ def datacenter_create():
     datacenter = manager.datacenter_create(data)
     location = "datacenters/%s" % (datacenter['id'])
     response.set_header("Location", location)
-    clear_cache()
+    clear_cache('datacenters')
     return datacenter
 
 
@@ -427,7 +462,7 @@ def datacenter_zone_create():
     zone = manager.zone_create(data['datacenter_id'], data)
     location = "zones/%s" % (zone['id'])
     response.set_header("Location", location)
-    clear_cache()
+    clear_cache('zones')
     return zone
 
 
@@ -451,7 +486,7 @@ def dhcp_create():
     dhcp = manager.dhcp_create(data=data)
     location = "dhcps/%s" % (dhcp['id'])
     response.set_header("Location", location)
-    clear_cache()
+    clear_cache('dhcps')
     return dhcp
 
 
@@ -475,7 +510,7 @@ def dhcp_add_vlan(dhcp_id):
     dhcp = manager.dhcp_add_vlan(dhcp_id, data['vlan_id'])
     location = "dhcps/relationship/%s" % (dhcp['id'])
     response.set_header("Location", location)
-    clear_cache()
+    clear_cache('dhcps')
     return dhcp
 
 
@@ -492,7 +527,7 @@ def dhcp_remove_vlan(dhcp_id, vlan_id):
     """
     manager = create_manager('dhcp')
     dhcp = manager.dhcp_remove_vlan(dhcp_id, vlan_id)
-    clear_cache()
+    clear_cache('dhcps')
     return dhcp
 
 
@@ -516,7 +551,7 @@ def firewall_create():
     firewall = manager.firewall_create(data=data)
     location = "firewalls/%s" % (firewall['id'])
     response.set_header("Location", location)
-    clear_cache()
+    clear_cache('firewalls')
     return firewall
 
 
@@ -540,7 +575,7 @@ def router_create():
     router = manager.router_create(data=data)
     location = "routers/%s" % (router['id'])
     response.set_header("Location", location)
-    clear_cache()
+    clear_cache('routers')
     return router
 
 
@@ -561,6 +596,7 @@ def firewall_enable():
         abort(400, 'No data received')
     data = json.loads(data)
     firewall = manager.firewall_enable(data=data)
+    clear_cache('firewalls')
     location = "firewalls/%s" % (firewall['id'])
     response.set_header("Location", location)
     return firewall
@@ -583,6 +619,7 @@ def firewall_enable():
         abort(400, 'No data received')
     data = json.loads(data)
     router = manager.router_enable(data=data)
+    clear_cache('routers')
     location = "routers/%s" % (router['id'])
     response.set_header("Location", location)
     return router
@@ -605,6 +642,7 @@ def firewall_disable():
         abort(400, 'No data received')
     data = json.loads(data)
     firewall = manager.firewall_disable(data=data)
+    clear_cache('firewalls')
     location = "firewalls/%s" % (firewall['id'])
     response.set_header("Location", location)
     return firewall
@@ -627,6 +665,7 @@ def router_disable():
         abort(400, 'No data received')
     data = json.loads(data)
     router = manager.router_disable(data=data)
+    clear_cache('routers')
     location = "routers/%s" % (firewall['id'])
     response.set_header("Location", location)
     return router
@@ -697,7 +736,7 @@ def zone_vlan_create():
     vlan = manager.vlan_create(data['zone_id'], data)
     location = "vlans/%s" % (vlan['id'])
     response.set_header("Location", location)
-    clear_cache()
+    clear_cache('vlans')
     return vlan
 
 
@@ -721,7 +760,7 @@ def firewall_add_anycast(firewall_id):
     firewall = manager.firewall_add_anycast(firewall_id, data)
     location = "firewall/relationship/%s" % (firewall['id'])
     response.set_header("Location", location)
-    clear_cache()
+    clear_cache('firewalls')
     return firewall
 
 
@@ -738,7 +777,7 @@ def firewall_remove_anycast(firewall_id, anycast_id):
     """
     manager = create_manager('firewall')
     firewall = manager.firewall_remove_anycast(firewall_id, anycast_id)
-    clear_cache()
+    clear_cache('firewalls')
     return firewall
 
 
@@ -762,7 +801,7 @@ def anycast_create():
     anycast = manager.anycast_create(data)
     location = "anycasts/%s" % (anycast['id'])
     response.set_header("Location", location)
-    clear_cache()
+    clear_cache('anycasts')
     return anycast
 
 
@@ -786,10 +825,68 @@ def vlan_subnet_create():
     subnet = manager.subnet_create(data['vlan_id'], data)
     location = "subnets/%s" % (subnet['id'])
     response.set_header("Location", location)
-    clear_cache()
+    clear_cache('subnets')
     return subnet
 
 
+@post('/v1/subnets/bulk')
+@handle_auth
+@reply_json
+def subnet_create_many():
+    """
+    ::
+
+      POST /v1/subnets/bulk
+
+    Create the subnets of a list, returning each new subnet or its error
+    """
+    manager = create_manager('base')
+    subnets = manager.subnet_create_many(bulk_input())
+    clear_cache('subnets')
+    return subnets
+
+
+@delete('/v1/subnets/bulk')
+@handle_auth
+@reply_json
+def subnet_delete_many():
+    """
+    ::
+
+      DELETE /v1/subnets/bulk
+
+    Delete the subnets of a list of ids, returning true or the error of each
+    """
+    manager = create_manager('base')
+    results = manager.subnet_delete_many(bulk_input())
+    clear_cache('subnets')
+    return results
+
+
+@post('/v1/subnets/<subnet_id>/allocate')
+@handle_auth
+@reply_json
+def subnet_ip_allocate(subnet_id):
+    """
+    ::
+
+      POST /v1/subnets/<subnet_id>/allocate
+
+    Create ips on the next free addresses of subnet, one unless a count
+    is given
+    """
+    manager = create_manager('base')
+    data = request.body.readline()
+    data = json.loads(data) if data else {}
+    try:
+        count = int(data.get('count', 1))
+    except (TypeError, ValueError):
+        abort(400, "Error: 'count' must be an integer")
+    ips = manager.ip_allocate(subnet_id, count)
+    clear_cache('ips')
+    return ips
+
+
 @post('/v1/anycastips')
 @handle_auth
 @validate_input(ip=str, anycast_id=str)
@@ -810,7 +907,7 @@ def anycast_anycastip_create():
     ip = manager.anycastip_create(data['anycast_id'], data)
     location = "anycastips/%s" % (ip['id'])
     response.set_header("Location", location)
-    clear_cache()
+    clear_cache('anycastips')
     return ip
 
 
@@ -834,10 +931,44 @@ def subnet_ip_create():
     ip = manager.ip_create(data['subnet_id'], data)
     location = "ips/%s" % (ip['id'])
     response.set_header("Location", location)
-    clear_cache()
+    clear_cache('ips')
     return ip
 
 
+@post('/v1/ips/bulk')
+@handle_auth
+@reply_json
+def ip_create_many():
+    """
+    ::
+
+      POST /v1/ips/bulk
+
+    Create the ips of a list, returning each new ip or its error
+    """
+    manager = create_manager('base')
+    ips = manager.ip_create_many(bulk_input())
+    clear_cache('ips')
+    return ips
+
+
+@delete('/v1/ips/bulk')
+@handle_auth
+@reply_json
+def ip_delete_many():
+    """
+    ::
+
+      DELETE /v1/ips/bulk
+
+    Delete the ips of a list of ids, returning true or the error of each
+    """
+    manager = create_manager('base')
+    results = manager.ip_delete_many(bulk_input())
+    clear_cache('ips')
+    return results
+
+
 @post('/v1/interfaces')
 @handle_auth
 @reply_json
@@ -857,7 +988,7 @@ def interface_create():
     interface = manager.interface_create(data)
     location = "interfaces/%s" % (interface['id'])
     response.set_header("Location", location)
-    clear_cache()
+    clear_cache('interfaces')
     return interface
 
 
@@ -878,7 +1009,7 @@ def interface_add_ip(interface_id):
         abort(400, 'No data received')
     data = json.loads(data)
     interface = manager.interface_add_ip(interface_id, data)
-    clear_cache()
+    clear_cache('interfaces', 'ips')
     return interface
 
 
@@ -895,7 +1026,7 @@ def interface_remove_ip(interface_id, ip_id):
     """
     manager = create_manager('base')
     interface = manager.interface_remove_ip(interface_id, ip_id)
-    clear_cache()
+    clear_cache('interfaces', 'ips')
     return interface
 
 @post('/v1/interfaces/<interface_id>/vlans')
@@ -915,7 +1046,7 @@ def interface_add_ip(interface_id):
         abort(400, 'No data received')
     data = json.loads(data)
     interface = manager.interface_add_vlan(interface_id, data)
-    clear_cache()
+    clear_cache('interfaces')
     return interface
 
 
@@ -932,5 +1063,5 @@ def interface_remove_ip(interface_id, vlan_id):
     """
     manager = create_manager('base')
     interface = manager.interface_remove_vlan(interface_id, vlan_id)
-    clear_cache()
+    clear_cache('interfaces')
     return interface
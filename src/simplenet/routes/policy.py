@@ -28,7 +28,7 @@ from simplenet.exceptions import (
     OperationNotPermited, FeatureNotAvailable
 )
 from simplenet.common.http_utils import (
-    reply_json, create_manager
+    reply_json, create_manager, paginated, bulk_input
 )
 
 logger = get_logger()
@@ -37,7 +37,8 @@ logger = get_logger()
 @get('/v1/firewalls')
 @handle_auth
 @reply_json
-def firewalls_list():
+@paginated
+def firewalls_list(**kwargs):
     """
     ::
 
@@ -48,7 +49,7 @@ def firewalls_list():
     manager = create_manager('firewall')
     try:
         _list = getattr(manager, 'firewall_list')
-        return _list()
+        return _list(**kwargs)
     except AttributeError:
         raise FeatureNotAvailable()
 
@@ -90,6 +91,37 @@ def policy_create(owner_type, id):
     return policy
 
 
+@post('/v1/firewalls/policies/bulk')
+@handle_auth
+@reply_json
+def policy_create_many():
+    """
+    ::
+
+      POST /v1/firewalls/policies/bulk
+
+    Create the policies of a list, each one naming its owner_type and
+    owner_id, returning each new policy or its error
+    """
+    manager = create_manager('firewall')
+    return manager.policy_create_many(bulk_input())
+
+
+@delete('/v1/firewalls/policies/bulk')
+@handle_auth
+@reply_json
+def policy_delete_many():
+    """
+    ::
+
+      DELETE /v1/firewalls/policies/bulk
+
+    Delete the policies of a list of owner_type and id pairs
+    """
+    manager = create_manager('firewall')
+    return manager.policy_delete_many(bulk_input())
+
+
 @delete('/v1/firewalls/policies/<owner_type:re:(?!by).+>/<id>')
 @handle_auth
 @reply_json
@@ -107,7 +139,8 @@ def policy_delete(owner_type, id):
 @get('/v1/firewalls/policies/by-type/<owner_type>')
 @handle_auth
 @reply_json
-def policy_list(owner_type):
+@paginated
+def policy_list(owner_type, **kwargs):
     """
     ::
 
@@ -116,7 +149,7 @@ def policy_list(owner_type):
     Get all policy
     """
     manager = create_manager('firewall')
-    return manager.policy_list(owner_type)
+    return manager.policy_list(owner_type, **kwargs)
 
 
 @get('/v1/firewalls/policies/by-owner/<owner_type>/<owner_id>')
@@ -28,7 +28,7 @@ from simplenet.exceptions import (
     OperationNotPermited, FeatureNotAvailable
 )
 from simplenet.common.http_utils import (
-    reply_json, create_manager
+    reply_json, create_manager, paginated, clear_cache
 )
 
 logger = get_logger()
@@ -36,7 +36,8 @@ logger = get_logger()
 @get('/v1/switches')
 @handle_auth
 @reply_json
-def switches_list():
+@paginated
+def switches_list(**kwargs):
     """
     ::
 
@@ -47,7 +48,7 @@ def switches_list():
     manager = create_manager('switch')
     try:
         _list = getattr(manager, 'switch_list')
-        return _list()
+        return _list(**kwargs)
     except AttributeError:
         raise FeatureNotAvailable()
 
@@ -69,6 +70,7 @@ def switch_create():
         abort(400, 'No data received')
     data = json.loads(data)
     switch = manager.switch_create(data=data)
+    clear_cache('switches')
     location = "switches/%s" % (switch['id'])
     response.set_header("Location", location)
     return switch
@@ -90,6 +92,7 @@ def switch_add_interface(switch_id):
         abort(400, 'No data received')
     data = json.loads(data)
     interface = manager.switch_add_interface(switch_id, data)
+    clear_cache('interfaces')
     return interface
 
 @delete('/v1/switches/<switch_id>/interfaces/<interface_id>')
@@ -105,4 +108,5 @@ def switch_remove_interface(switch_id, interface_id):
     """
     manager = create_manager('switch')
     interface = manager.switch_remove_interface(switch_id, interface_id)
+    clear_cache('interfaces')
     return interface
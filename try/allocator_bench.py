@@ -0,0 +1,87 @@
+#!/usr/bin/python
+
+# Copyright 2012 Locaweb.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+# Fills a subnet up to used addresses in one bulk allocation, then times
+# single address allocations through ip_allocate against listing the
+# subnet ips to pick a free address for ip_create.
+#
+# Usage: PYTHONPATH=../src python allocator_bench.py [used] [calls]
+#
+# It uses the database configured on /etc/simplenet/simplenet.cfg, creating
+# a synthetic subnet and removing it afterwards.
+
+import sys
+import time
+import uuid
+
+from ipaddr import IPNetwork
+from sqlalchemy import event
+
+from simplenet.db import models
+from simplenet.db.models import Ip
+from simplenet.network_appliances.base import Net
+
+queries = [0]
+
+def count_queries(conn, cursor, statement, parameters, context, executemany):
+    queries[0] += 1
+
+event.listen(models.engine, "before_cursor_execute", count_queries)
+
+
+def pick_and_create(net, subnet):
+    used = set(ip['ip'] for ip in net.ip_list_by_subnet(subnet['id']))
+    network = IPNetwork(subnet['cidr'])
+    for address in network.iterhosts():
+        address = str(address)
+        if address != subnet['gateway'] and address not in used:
+            return net.ip_create(subnet['id'], {'ip': address})
+
+
+def measure(name, f, calls):
+    queries[0] = 0
+    start = time.time()
+    for i in range(calls):
+        f()
+    duration = time.time() - start
+    print "%-16s queries/call: %-6.1f time/call: %.2fms" % (
+        name, float(queries[0]) / calls, duration * 1000 / calls
+    )
+
+
+if __name__ == '__main__':
+    used = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    calls = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    net = Net()
+    tag = str(uuid.uuid4())[:8]
+    dc = net.datacenter_create({'name': 'bench-dc-%s' % tag})
+    zone = net.zone_create(dc['id'], {'name': 'bench-zone-%s' % tag})
+    vlan = net.vlan_create(zone['id'], {'name': 'bench-vlan-%s' % tag,
+                                        'type': 'private_vlan', 'vlan_num': 1})
+    subnet = net.subnet_create(vlan['id'], {'cidr': '10.253.0.0/16'})
+    try:
+        start = time.time()
+        net.ip_allocate(subnet['id'], used)
+        print "bulk allocation of %s: %.2fs" % (used, time.time() - start)
+        measure("list and create", lambda: pick_and_create(net, subnet), calls)
+        measure("allocate", lambda: net.ip_allocate(subnet['id']), calls)
+    finally:
+        net.session.query(Ip).filter_by(subnet_id=subnet['id']).delete()
+        net.subnet_delete(subnet['id'])
+        net.vlan_delete(vlan['id'])
+        net.zone_delete(zone['id'])
+        net.datacenter_delete(dc['id'])
@@ -0,0 +1,108 @@
+#!/usr/bin/python
+
+# Copyright 2012 Locaweb.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+# Counts the queries needed to resolve an ip up to its datacenter, through
+# the old chain of *_info calls and through the ancestry lookup.
+#
+# Usage: PYTHONPATH=../src python ancestry_bench.py [calls]
+#
+# It uses the database configured on /etc/simplenet/simplenet.cfg, creating
+# a synthetic hierarchy and removing it afterwards.
+
+import sys
+import time
+import uuid
+
+from sqlalchemy import event
+
+from simplenet.db import models
+from simplenet.network_appliances import base
+from simplenet.network_appliances.base import Net
+
+queries = [0]
+
+def count_queries(conn, cursor, statement, parameters, context, executemany):
+    queries[0] += 1
+
+event.listen(models.engine, "before_cursor_execute", count_queries)
+
+
+def populate(net):
+    tag = str(uuid.uuid4())[:8]
+    dc = net.datacenter_create({'name': 'bench-dc-%s' % tag})
+    zone = net.zone_create(dc['id'], {'name': 'bench-zone-%s' % tag})
+    vlan = net.vlan_create(zone['id'], {'name': 'bench-vlan-%s' % tag,
+                                        'type': 'private_vlan', 'vlan_num': 1})
+    subnet = net.subnet_create(vlan['id'], {'cidr': '10.254.254.0/24'})
+    ip = net.ip_create(subnet['id'], {'ip': '10.254.254.10'})
+    return dc, zone, vlan, subnet, ip
+
+
+def cleanup(net, dc, zone, vlan, subnet, ip):
+    net.ip_delete(ip['id'])
+    net.subnet_delete(subnet['id'])
+    net.vlan_delete(vlan['id'])
+    net.zone_delete(zone['id'])
+    net.datacenter_delete(dc['id'])
+
+
+def cascade(net, id):
+    ip = net.ip_info(id)
+    subnet = net.subnet_info(ip['subnet_id'])
+    vlan = net.vlan_info(subnet['vlan_id'])
+    zone = net.zone_info(vlan['zone_id'])
+    datacenter = net.datacenter_info(zone['datacenter_id'])
+    return {
+        'ip': ip['ip'],
+        'subnet': subnet['cidr'],
+        'subnet_id': subnet['id'],
+        'vlan': vlan['name'],
+        'vlan_id': vlan['id'],
+        'zone': zone['name'],
+        'zone_id': zone['id'],
+        'datacenter': datacenter['name'],
+        'datacenter_id': datacenter['id'],
+    }
+
+
+def measure(name, f, net, id, calls, cold=False):
+    queries[0] = 0
+    start = time.time()
+    for i in range(calls):
+        if cold:
+            base._ancestry_cache.clear()
+        net.session.expire_all()
+        data = f(net, id)
+    duration = time.time() - start
+    print "%-10s queries/call: %-6.1f time/call: %.2fms" % (
+        name, float(queries[0]) / calls, duration * 1000 / calls
+    )
+    return data
+
+
+if __name__ == '__main__':
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    net = Net()
+    entities = populate(net)
+    try:
+        ip = entities[-1]
+        old = measure("cascade", cascade, net, ip['id'], calls)
+        new = measure("ancestry", lambda n, i: n._get_data_ip_(i), net, ip['id'], calls, cold=True)
+        cached = measure("cached", lambda n, i: n._get_data_ip_(i), net, ip['id'], calls)
+        assert old == new == cached
+    finally:
+        cleanup(net, *entities)
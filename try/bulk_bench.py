@@ -0,0 +1,93 @@
+#!/usr/bin/python
+
+# Copyright 2012 Locaweb.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+# Creates and deletes the ips of a subnet one by one and through the bulk
+# calls, counting queries and time.
+#
+# Usage: PYTHONPATH=../src python bulk_bench.py [ips]
+#
+# It uses the database configured on /etc/simplenet/simplenet.cfg, creating
+# a synthetic hierarchy and removing it afterwards.
+
+import sys
+import time
+import uuid
+
+from ipaddr import IPNetwork
+from sqlalchemy import event
+
+from simplenet.db import models
+from simplenet.network_appliances.base import Net
+
+queries = [0]
+
+def count_queries(conn, cursor, statement, parameters, context, executemany):
+    queries[0] += 1
+
+event.listen(models.engine, "before_cursor_execute", count_queries)
+
+
+def populate(net):
+    tag = str(uuid.uuid4())[:8]
+    dc = net.datacenter_create({'name': 'bench-dc-%s' % tag})
+    zone = net.zone_create(dc['id'], {'name': 'bench-zone-%s' % tag})
+    vlan = net.vlan_create(zone['id'], {'name': 'bench-vlan-%s' % tag,
+                                        'type': 'private_vlan', 'vlan_num': 1})
+    subnet = net.subnet_create(vlan['id'], {'cidr': '10.252.0.0/16'})
+    return dc, zone, vlan, subnet
+
+
+def cleanup(net, dc, zone, vlan, subnet):
+    net.subnet_delete(subnet['id'])
+    net.vlan_delete(vlan['id'])
+    net.zone_delete(zone['id'])
+    net.datacenter_delete(dc['id'])
+
+
+def one_by_one(net, subnet, addresses):
+    ips = [net.ip_create(subnet['id'], {'ip': ip}) for ip in addresses]
+    for ip in ips:
+        net.ip_delete(ip['id'])
+
+
+def bulk(net, subnet, addresses):
+    ips = net.ip_create_many(
+        [{'ip': ip, 'subnet_id': subnet['id']} for ip in addresses]
+    )
+    net.ip_delete_many([ip['id'] for ip in ips])
+
+
+def measure(name, f, net, subnet, addresses):
+    queries[0] = 0
+    start = time.time()
+    f(net, subnet, addresses)
+    print "%-12s queries: %-8s time: %.2fs" % (
+        name, queries[0], time.time() - start
+    )
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    net = Net()
+    entities = populate(net)
+    try:
+        hosts = IPNetwork(entities[-1]['cidr']).iterhosts()
+        addresses = [str(hosts.next()) for i in range(count + 1)][1:]
+        measure("one by one", one_by_one, net, entities[-1], addresses)
+        measure("bulk", bulk, net, entities[-1], addresses)
+    finally:
+        cleanup(net, *entities)
@@ -0,0 +1,93 @@
+#!/usr/bin/python
+
+# Copyright 2012 Locaweb.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+# Times sn-fw-agent's RuleGenerator over a synthetic payload, and the old
+# list scan dedup over a smaller one for comparison. Nothing is applied to
+# iptables.
+#
+# Usage: python fw_rulegen_bench.py [policies] [legacy_policies]
+
+import imp
+import logging
+import os
+import sys
+import time
+import uuid
+
+agent = imp.load_source(
+    'sn_fw_agent',
+    os.path.join(os.path.dirname(__file__), '..', 'src', 'agents', 'sn-fw-agent')
+)
+
+
+class ListScanGenerator(agent.RuleGenerator):
+
+    def _add_rule_(self, rule):
+        if rule not in self.iptables_save:
+            if rule.endswith("REJECT"): rule += " --reject-with icmp-port-unreachable"
+            self.iptables_save.append(rule)
+
+
+def payload(total):
+    vlans, policies = [], []
+    subnets_per_vlan, ips_per_subnet = 10, 250
+    ips = 0
+    v = 0
+    while ips < total:
+        vlan = {'vlan': 'vlan%s' % v, 'vlan_id': str(uuid.uuid4()),
+                'zone': 'zone01', 'datacenter': 'dc01', 'subnets': []}
+        for s in range(subnets_per_vlan):
+            cidr = '10.%s.%s.0/24' % (v, s)
+            subnet = {'id': str(uuid.uuid4()), 'cidr': cidr, 'ips': []}
+            for i in range(1, ips_per_subnet + 1):
+                if ips >= total:
+                    break
+                ip = '10.%s.%s.%s' % (v, s, i)
+                subnet['ips'].append({'id': str(uuid.uuid4()), 'ip': ip,
+                                      'subnet': cidr})
+                policies.append({
+                    'id': str(uuid.uuid4()), 'table': 'FORWARD',
+                    'proto': 'tcp', 'src': '', 'src_port': '', 'dst': ip,
+                    'dst_port': str(1024 + ips % 20000), 'owner': ip,
+                    'policy': 'ACCEPT', 'status': 'INSERTED',
+                })
+                ips += 1
+            vlan['subnets'].append(subnet)
+        vlans.append(vlan)
+        v += 1
+    return {'zone': 'zone01', 'datacenter': 'dc01', 'vlans': vlans,
+            'anycasts': [], 'anycastips': [], 'policy': policies}
+
+
+def measure(name, cls, total):
+    data = payload(total)
+    generator = cls('/nonexistent', 'eth0', logging.getLogger(name))
+    start = time.time()
+    lines = generator.generate(data)
+    print "%-10s policies: %-8s lines: %-8s time: %.3fs" % (
+        name, total, len(lines), time.time() - start
+    )
+    return lines
+
+
+if __name__ == '__main__':
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    legacy = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+    old = measure("list scan", ListScanGenerator, legacy)
+    new = measure("set", agent.RuleGenerator, legacy)
+    assert old == new
+    measure("set", agent.RuleGenerator, total)
@@ -0,0 +1,38 @@
+#!/usr/bin/python
+
+# Copyright 2012 Locaweb.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+# Migrates the schema and checks, through EXPLAIN, that the list-by-parent,
+# policy and address lookups use an index. Exits with 1 if any of them scans
+# its table.
+#
+# Usage: PYTHONPATH=../src python index_check.py
+#
+# It uses the database configured on /etc/simplenet/simplenet.cfg.
+
+import sys
+
+from simplenet.db.migrations import migrate, explain_hot_queries
+
+
+if __name__ == '__main__':
+    print "schema version: %s" % migrate()
+    scans = 0
+    for name, index in explain_hot_queries():
+        print "%-24s %s" % (name, index or "TABLE SCAN")
+        if not index:
+            scans += 1
+    sys.exit(1 if scans else 0)
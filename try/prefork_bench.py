@@ -0,0 +1,125 @@
+#!/usr/bin/python
+
+# Copyright 2012 Locaweb.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+# Serves the API with 1, 2, 4... prefork workers and measures the requests
+# per second listing ips from concurrent client processes.
+#
+# Usage: PYTHONPATH=../src python prefork_bench.py [max_workers] [seconds] [clients]
+#
+# It uses the database configured on /etc/simplenet/simplenet.cfg, creating
+# a synthetic hierarchy and removing it afterwards. The ack consumer isn't
+# started.
+
+from gevent import monkey
+monkey.patch_all()
+
+import os
+import signal
+import sys
+import time
+import urllib2
+import uuid
+
+import bottle
+
+from simplenet.common import prefork
+from simplenet.common.event import batch_events
+from simplenet.db import models
+from simplenet.db.db_utils import request_session
+from simplenet.network_appliances.base import Net
+from simplenet.routes import base
+
+PORT = 18081
+
+
+def populate(net, ips):
+    tag = str(uuid.uuid4())[:8]
+    dc = net.datacenter_create({'name': 'bench-dc-%s' % tag})
+    zone = net.zone_create(dc['id'], {'name': 'bench-zone-%s' % tag})
+    vlan = net.vlan_create(zone['id'], {'name': 'bench-vlan-%s' % tag,
+                                        'type': 'private_vlan', 'vlan_num': 1})
+    subnet = net.subnet_create(vlan['id'], {'cidr': '10.251.0.0/16'})
+    net.ip_allocate(subnet['id'], ips)
+    return dc, zone, vlan, subnet
+
+
+def cleanup(net, dc, zone, vlan, subnet):
+    net.ip_delete_many([ip['id'] for ip in net.ip_list_by_subnet(subnet['id'])])
+    net.subnet_delete(subnet['id'])
+    net.vlan_delete(vlan['id'])
+    net.zone_delete(zone['id'])
+    net.datacenter_delete(dc['id'])
+
+
+def client(url, seconds):
+    """Forks a process requesting url for seconds, returning the pipe where
+    it writes how many requests it made"""
+    read, write = os.pipe()
+    if os.fork():
+        os.close(write)
+        return read
+    os.close(read)
+    done = 0
+    limit = time.time() + seconds
+    while time.time() < limit:
+        urllib2.urlopen(url).read()
+        done += 1
+    os.write(write, str(done))
+    os._exit(0)
+
+
+def measure(listener, app, workers, seconds, clients):
+    pid = os.fork()
+    if not pid:
+        build = lambda: [
+            prefork.Worker("http", lambda: prefork.serve(listener, app, 1000, 5))
+            for i in range(workers)
+        ]
+        prefork.Master(build, models.engine.dispose, 5).run()
+        os._exit(0)
+    time.sleep(1)
+    url = "http://127.0.0.1:%s/v1/ips?limit=100" % PORT
+    try:
+        pipes = [client(url, seconds) for i in range(clients)]
+        done = sum(int(os.read(pipe, 32) or 0) for pipe in pipes)
+        for pipe in pipes:
+            os.close(pipe)
+            os.wait()
+    finally:
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+    print "workers: %-3s requests/s: %.1f" % (workers, float(done) / seconds)
+
+
+if __name__ == '__main__':
+    max_workers = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    seconds = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    clients = int(sys.argv[3]) if len(sys.argv) > 3 else 8
+    net = Net()
+    entities = populate(net, 1000)
+    models.engine.dispose()
+    app = bottle.app()
+    app.install(request_session)
+    app.install(batch_events)
+    listener = prefork.listen("127.0.0.1", PORT)
+    try:
+        workers = 1
+        while workers <= max_workers:
+            measure(listener, app, workers, seconds, clients)
+            workers *= 2
+    finally:
+        cleanup(net, *entities)
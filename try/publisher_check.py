@@ -0,0 +1,105 @@
+#!/usr/bin/python
+
+# Copyright 2012 Locaweb.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+# Checks the event Publisher against kombu's in-memory transport: entities
+# are declared once per connection, published messages can be consumed
+# back, and a lost connection is retried, counted and makes the entities be
+# declared again. Exits with 1 if any check fails.
+#
+# Usage: PYTHONPATH=../src python publisher_check.py
+
+import sys
+
+from kombu import BrokerConnection, Exchange, Queue
+from kombu.transport import memory
+
+from simplenet.common.event import Publisher
+
+failures = []
+declared = []
+
+
+def check(name, ok):
+    print "%-40s %s" % (name, "ok" if ok else "FAILED")
+    if not ok:
+        failures.append(name)
+
+
+def counting(cls):
+    declare = cls.declare
+
+    def _declare(self, *args, **kwargs):
+        declared.append(self.name)
+        return declare(self, *args, **kwargs)
+    cls.declare = _declare
+
+
+def fail_once(error):
+    """Makes the next message put on a memory queue fail with error, as if
+    the broker connection was lost"""
+    put = memory.Channel._put
+
+    def _put(self, queue, message, **kwargs):
+        memory.Channel._put = put
+        raise error
+    memory.Channel._put = _put
+
+
+def consume(queue, expected):
+    received = []
+    with BrokerConnection("memory://") as conn:
+        with conn.Consumer([queue], callbacks=[lambda body, message: (
+            received.append(body), message.ack()
+        )]):
+            for i in xrange(expected):
+                conn.drain_events(timeout=1)
+    return received
+
+
+if __name__ == '__main__':
+    counting(Exchange)
+    counting(Queue)
+    # The memory transport never loses its connection, so it declares none
+    # of its errors as connection errors
+    memory.Transport.connection_errors = (IOError,)
+
+    exchange = Exchange("simplenet", type="direct", durable=True)
+    queue = Queue("check", exchange=exchange, routing_key="check")
+    publisher = Publisher("memory://", 2)
+
+    publisher.publish(exchange, {'seq': 1}, "check", [queue])
+    first = list(declared)
+    publisher.publish(exchange, {'seq': 2}, "check", [queue])
+    check("declared on the first publish", set(first) == set(["check", "simplenet"]))
+    check("not declared on the second publish", declared == first)
+    check("declarations cached", len(publisher.declared) == 2)
+    check("messages consumed back",
+          [x['seq'] for x in consume(queue, 2)] == [1, 2])
+
+    before = publisher.stats()
+    del declared[:]
+    fail_once(IOError("connection lost"))
+    publisher.publish(exchange, {'seq': 3}, "check", [queue])
+    after = publisher.stats()
+    check("reconnect counted", after['reconnects'] == before['reconnects'] + 1)
+    check("declared again after reconnect", declared == first)
+    check("published counted", after['published'] == before['published'] + 1)
+    check("no errors counted", after['errors'] == 0)
+    check("message sent after reconnect",
+          [x['seq'] for x in consume(queue, 1)] == [3])
+
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,121 @@
+#!/usr/bin/python
+
+# Copyright 2012 Locaweb.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+# Lists every resource through the models to_dict and through the
+# projections, counting queries and time, and checks both give the same
+# JSON.
+#
+# Usage: PYTHONPATH=../src python serializers_bench.py [subnets] [ips_per_subnet]
+#
+# It uses the database configured on /etc/simplenet/simplenet.cfg, creating
+# a synthetic hierarchy and removing it afterwards.
+
+import sys
+import time
+import uuid
+
+from sqlalchemy import event
+
+from simplenet.common.http_utils import dumps
+from simplenet.db import models
+from simplenet.db.models import (
+    Datacenter, Zone, Vlan, Subnet, Ip, Interface, Switch, Firewall, IpPolicy
+)
+from simplenet.network_appliances.base import Net
+
+queries = [0]
+
+def count_queries(conn, cursor, statement, parameters, context, executemany):
+    queries[0] += 1
+
+event.listen(models.engine, "before_cursor_execute", count_queries)
+
+RESOURCES = (
+    'Datacenter', 'Zone', 'Vlan', 'Subnet', 'Ip', 'Interface', 'Switch',
+    'Firewall', 'IpPolicy',
+)
+
+
+def populate(session, subnets, ips_per_subnet):
+    tag = str(uuid.uuid4())[:8]
+    created = []
+    dc = Datacenter('bench-dc-%s' % tag)
+    zone = Zone('bench-zone-%s' % tag, dc.id)
+    vlan = Vlan('bench-vlan-%s' % tag, zone.id, 'private_vlan', 1)
+    switch = Switch('bench-switch-%s' % tag)
+    firewall = Firewall('bench-fw-%s' % tag, zone.id, None, True)
+    created += [dc, zone, vlan, switch, firewall]
+    for s in range(subnets):
+        subnet = Subnet('10.%s.%s.0/24' % (200 + s / 256, s % 256), vlan.id)
+        created.append(subnet)
+        for i in range(ips_per_subnet):
+            ip = Ip('10.%s.%s.%s' % (200 + s / 256, s % 256, i + 1), subnet.id)
+            interface = Interface('%s-%s-%s' % (tag, s, i), 'host-%s-%s' % (s, i))
+            interface.switch_id = switch.id
+            interface.vlan_id = vlan.id
+            ip.interface_id = interface.id
+            policy = IpPolicy(proto='tcp', src='', src_port='', dst=ip.ip,
+                              dst_port='80', table='INPUT', policy='ACCEPT',
+                              owner_id=ip.id, in_iface='', out_iface='')
+            created += [interface, ip, policy]
+    session.begin(subtransactions=True)
+    session.add_all(created)
+    session.commit()
+    return [(type(entity), entity.id) for entity in created]
+
+
+def cleanup(session, created):
+    session.expunge_all()
+    session.begin(subtransactions=True)
+    for model, id in reversed(created):
+        session.query(model).filter_by(id=id).delete()
+    session.commit()
+
+
+def to_dict_list(net, model_name):
+    model, name = models.new_model(model_name)
+    return [value.to_dict() for value in net.session.query(model)]
+
+
+def measure(net, model_name, f):
+    net.session.expunge_all()
+    queries[0] = 0
+    start = time.time()
+    data = f(net, model_name)
+    return data, queries[0], time.time() - start
+
+
+if __name__ == '__main__':
+    subnets = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    ips_per_subnet = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    net = Net()
+    created = populate(net.session, subnets, ips_per_subnet)
+    try:
+        print "%-12s %-8s %18s %18s" % ("resource", "entries", "to_dict", "projection")
+        for model_name in RESOURCES:
+            old, old_queries, old_time = measure(net, model_name, to_dict_list)
+            new, new_queries, new_time = measure(
+                net, model_name, lambda n, m: n._generic_list_(m)
+            )
+            key = lambda value: value['id']
+            assert dumps(sorted(old, key=key)) == dumps(sorted(new, key=key))
+            print "%-12s %-8s %6sq %9.1fms %6sq %9.1fms" % (
+                model_name, len(new), old_queries, old_time * 1000,
+                new_queries, new_time * 1000
+            )
+    finally:
+        cleanup(net.session, created)
@@ -0,0 +1,157 @@
+#!/usr/bin/python
+
+# Copyright 2012 Locaweb.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+# Compares the firewall payload built by the zone snapshot against the old
+# zone -> vlans -> subnets -> ips cascade, counting queries and wall time.
+#
+# Usage: PYTHONPATH=../src python zone_snapshot_bench.py [ips]
+#
+# It uses the database configured on /etc/simplenet/simplenet.cfg, creating
+# a synthetic zone and removing it afterwards.
+
+import sys
+import time
+import uuid
+
+from sqlalchemy import event
+
+from simplenet.db import models
+from simplenet.db.models import (
+    Datacenter, Zone, Vlan, Subnet, Ip, Firewall, Policy
+)
+from simplenet.network_appliances.firewall import Net, session
+
+queries = [0]
+
+def count_queries(conn, cursor, statement, parameters, context, executemany):
+    queries[0] += 1
+
+event.listen(models.engine, "before_cursor_execute", count_queries)
+
+
+def populate(total_ips):
+    tag = str(uuid.uuid4())[:8]
+    dc = Datacenter(name="bench-dc-%s" % tag)
+    zone = Zone(name="bench-zone-%s" % tag, datacenter_id=dc.id)
+    fw = Firewall(name="bench-fw-%s" % tag, zone_id=zone.id, mac=None, status=True)
+    session.begin()
+    session.add_all([dc, zone, fw])
+    session.flush()
+    ips, policies, subnets, vlans = [], [], [], []
+    for v in range(total_ips / 2540 + 1):
+        vlan = Vlan(name="bench-vlan-%s-%s" % (tag, v), zone_id=zone.id,
+                    type="private_vlan", vlan_num=v)
+        vlans.append(vlan)
+        for s in range(10):
+            if len(ips) >= total_ips:
+                break
+            subnet = Subnet(cidr="10.%s.%s.0/24" % (v, s), vlan_id=vlan.id)
+            subnets.append(subnet)
+            for i in range(1, 255):
+                if len(ips) >= total_ips:
+                    break
+                ip = Ip(ip="10.%s.%s.%s" % (v, s, i), subnet_id=subnet.id)
+                ips.append(ip)
+                policies.append({
+                    'id': str(uuid.uuid4()), 'owner_type': 'ip',
+                    'owner_id': ip.id, 'proto': 'tcp', 'src': '',
+                    'src_port': '', 'dst': ip.ip, 'dst_port': '80',
+                    'table': 'INPUT', 'policy': 'ACCEPT', 'status': 'PENDING',
+                    'in_iface': '', 'out_iface': '',
+                })
+    session.add_all(vlans)
+    session.flush()
+    session.add_all(subnets)
+    session.flush()
+    session.execute(Ip.__table__.insert(), [
+        {'id': ip.id, 'ip': ip.ip, 'subnet_id': ip.subnet_id} for ip in ips
+    ])
+    session.execute(Policy.__table__.insert(), policies)
+    session.commit()
+    return fw.to_dict(), [dc, zone, fw] + vlans + subnets
+
+
+def cleanup(device, entities):
+    zone_id = device['zone_id']
+    vlans = session.query(Vlan.id).filter(Vlan.zone_id == zone_id)
+    subnets = session.query(Subnet.id).filter(Subnet.vlan_id.in_(vlans.subquery()))
+    ips = session.query(Ip.id).filter(Ip.subnet_id.in_(subnets.subquery()))
+    session.begin()
+    session.query(Policy).filter(Policy.owner_id.in_(ips.subquery())).delete(synchronize_session=False)
+    session.query(Ip).filter(Ip.subnet_id.in_(subnets.subquery())).delete(synchronize_session=False)
+    for entity in reversed(entities):
+        session.delete(entity)
+    session.commit()
+
+
+def cascade(net, device):
+    zone_id = device['zone_id']
+    owners_ids = []
+    data = net._get_data_zone_(zone_id)
+    policy_list = net.policy_list_by_owner('zone', zone_id)
+    for vlan in net.vlan_list_by_zone(zone_id):
+        owners_ids.append(vlan['id'])
+        for subnet in net.subnet_list_by_vlan(vlan['id']):
+            owners_ids.append(subnet['id'])
+            for ip in net.ip_list_by_subnet(subnet['id']):
+                owners_ids.append(ip['id'])
+    data['anycasts'] = []
+    data['anycastips'] = []
+    for anycast in net.anycast_list_by_firewall(device['id']):
+        owners_ids.append(anycast['anycast_id'])
+        data['anycasts'].append(anycast)
+        for anycastip in net.anycastip_list_by_anycast(anycast['anycast_id']):
+            data['anycastips'].append(anycastip)
+            owners_ids.append(anycastip['id'])
+    data['policy'] = policy_list + net.policy_list_by_owners(owners_ids)
+    return data
+
+
+def snapshot(net, device):
+    zone = net._get_zone_snapshot_(device['zone_id'])
+    anycasts = net._get_device_snapshot_(device['id'])
+    data = dict(zone)
+    data.update(anycasts)
+    data['policy'] = zone['policy'] + anycasts['policy']
+    return data
+
+
+def measure(name, f, net, device):
+    session.expire_all()
+    queries[0] = 0
+    start = time.time()
+    data = f(net, device)
+    duration = time.time() - start
+    print "%-10s queries: %-8s time: %.3fs policies: %s" % (
+        name, queries[0], duration, len(data['policy'])
+    )
+    return data
+
+
+if __name__ == '__main__':
+    total_ips = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    print "Populating synthetic zone with %s ips" % total_ips
+    device, entities = populate(total_ips)
+    try:
+        net = Net()
+        old = measure("cascade", cascade, net, device)
+        new = measure("snapshot", snapshot, net, device)
+        key = lambda p: p['id']
+        assert sorted(old['policy'], key=key) == sorted(new['policy'], key=key)
+        assert old['vlans'] == new['vlans']
+    finally:
+        cleanup(device, entities)